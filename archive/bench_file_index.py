@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Micro benchmarks for file_index.py.
+
+    bench_file_index.py hash DIR [-j N ...]
+
+Hash every file under DIR once with a `sha1sum -b` subprocess per file (the
+old file_index code path) and once with the in-process Hasher for every
+requested number of jobs. Files are read once before timing, so the numbers
+are for a warm page cache and show the per-file overhead, not the disk.
+
+    bench_file_index.py load INDEX
+
+Load INDEX into the "already indexed" lookup the way file_index.py does and
+into the set of SHA-1 digests it used before. Each variant runs in its own
+process and reports the load time and the peak RSS.
+"""
+
+import argparse
+import hashlib
+import io
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import file_index
+import index_format
+
+
+def list_files(top):
+    files = []
+    for dirpath, _, filenames in os.walk(top):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                files.append((path, os.stat(path)))
+    return files
+
+
+def report(name, files, seconds):
+    size = sum(st.st_size for _, st in files)
+    print(
+        "{:24s} {:8d} files {:10.1f} MB {:8.2f} s {:10.1f} files/s {:8.1f} MB/s".format(
+            name,
+            len(files),
+            size / 1024**2,
+            seconds,
+            len(files) / seconds,
+            size / 1024**2 / seconds,
+        )
+    )
+
+
+def bench_subprocess(files):
+    start = time.perf_counter()
+    for path, _ in files:
+        subprocess.check_output(["sha1sum", "-b", path])
+    return time.perf_counter() - start
+
+
+def bench_hasher(files, jobs):
+    file_index.counter = file_index.Counter()
+    start = time.perf_counter()
+    hasher = file_index.Hasher(io.StringIO(), io.StringIO(), jobs)
+    for path, st in files:
+        hasher.submit(path, st)
+    hasher.close()
+    return time.perf_counter() - start
+
+
+def cmd_hash(args):
+    files = list_files(args.dir)
+    if not files:
+        print("No files found in {}".format(args.dir))
+        return
+    # warm up the page cache
+    for path, _ in files:
+        file_index.sha1_file(path)
+
+    report("sha1sum subprocess", files, bench_subprocess(files))
+    for jobs in args.jobs or [1, os.cpu_count() or 1]:
+        report("hashlib jobs={}".format(jobs), files, bench_hasher(files, jobs))
+
+
+def load_digest_set(path):
+    index = set()
+    for row in index_format.read_index(path):
+        v = ":".join((row[3], row[1], row[2]))
+        index.add(hashlib.sha1(v.encode("utf-8")).digest())
+    return index
+
+
+def load_fingerprint_set(path):
+    file_index.load_index(path)
+    return file_index.index
+
+
+LOADERS = {
+    "digest-set": load_digest_set,
+    "fingerprint-set": load_fingerprint_set,
+}
+
+
+def cmd_load(args):
+    if args.impl:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        index = LOADERS[args.impl](args.index)
+        seconds = time.perf_counter() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+        print(
+            "{:24s} {:10d} entries {:8.2f} s {:10.1f} MB peak RSS".format(
+                args.impl, len(index), seconds, peak / 1024
+            )
+        )
+        return
+    for impl in LOADERS:
+        subprocess.check_call(
+            [sys.executable, __file__, "load", "--impl", impl, args.index]
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark file_index.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("hash", help="Compare sha1sum subprocess and Hasher")
+    p.add_argument("dir")
+    p.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        action="append",
+        help="Number of hasher jobs. Can be repeated",
+    )
+    p.set_defaults(func=cmd_hash)
+
+    p = commands.add_parser("load", help="Compare index lookup structures")
+    p.add_argument("index")
+    p.add_argument("--impl", choices=LOADERS, help=argparse.SUPPRESS)
+    p.set_defaults(func=cmd_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
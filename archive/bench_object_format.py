@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Micro benchmarks for object_format.py.
+
+    bench_object_format.py cdc [FILE ...]
+
+Cut every FILE in content defined chunks, report their sizes and the
+throughput, then insert a line at a third of the data and count the chunks
+that are not shared with the original. The insertion should change only the
+chunk it falls in and, if that one was cut at CDC_MAX, the next one. Without
+FILE, a generated log and random data of the same size are used. The exit
+status is 1 if an insertion changed more chunks.
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import sys
+import time
+
+import object_format
+
+SAMPLE_SIZE = 64 * 1024**2
+INSERTION = b"2026-01-01 00:00:00.000 INFO inserted line\n"
+
+
+def log_sample(size):
+    """Return size bytes of log lines, the same every time."""
+    rng = random.Random(0)
+    lines = []
+    total = 0
+    t = 0
+    while total < size:
+        t += rng.randint(1, 500)
+        line = (
+            "2026-01-{:02d} {:02d}:{:02d}:{:02d}.{:03d} {} [worker-{}] request "
+            "id={:08x} path=/api/v1/items/{} status={} took={}ms\n".format(
+                1 + t // 86400000 % 28,
+                t // 3600000 % 24,
+                t // 60000 % 60,
+                t // 1000 % 60,
+                t % 1000,
+                rng.choice(("INFO", "WARN", "DEBUG", "ERROR")),
+                rng.randint(1, 16),
+                rng.getrandbits(32),
+                rng.randint(1, 99999),
+                rng.choice((200, 200, 200, 404, 500)),
+                rng.randint(1, 900),
+            )
+        )
+        lines.append(line)
+        total += len(line)
+    return "".join(lines).encode()[:size]
+
+
+def chunks(data):
+    cuts = []
+    offset = 0
+    while offset < len(data):
+        offset += object_format.find_cut(
+            data[offset : offset + object_format.CDC_MAX]
+        )
+        cuts.append(offset)
+    return [data[a:b] for a, b in zip([0] + cuts, cuts)]
+
+
+def check_cdc(name, data):
+    """Report the chunks of data, return the chunks changed by an insertion."""
+    start = time.perf_counter()
+    old = chunks(data)
+    seconds = time.perf_counter() - start
+    sizes = sorted(len(c) for c in old)
+    print(
+        "{:24s} {:8.1f} MB {:6d} chunks {:8d} median {:6d} at max {:8.1f} MB/s".format(
+            name,
+            len(data) / 1024**2,
+            len(old),
+            sizes[len(sizes) // 2],
+            sizes.count(object_format.CDC_MAX),
+            len(data) / 1024**2 / seconds,
+        )
+    )
+    at = len(data) // 3
+    new = chunks(data[:at] + INSERTION + data[at:])
+    digests = {hashlib.sha1(c).digest() for c in old}
+    changed = sum(hashlib.sha1(c).digest() not in digests for c in new)
+    print("{:24s} {:6d} chunks changed by an insertion".format("", changed))
+    return changed
+
+
+def cmd_cdc(args):
+    if args.files:
+        samples = ((path, open(path, "rb").read()) for path in args.files)
+    else:
+        samples = (
+            ("generated log", log_sample(SAMPLE_SIZE)),
+            ("random data", os.urandom(SAMPLE_SIZE)),
+        )
+    failed = False
+    for name, data in samples:
+        if len(data) <= object_format.CDC_MIN:
+            print("{}: not larger than CDC_MIN, skipped".format(name))
+            continue
+        failed |= check_cdc(name, data) > 2
+    sys.exit(1 if failed else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark object_format.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("cdc", help="Check content defined chunks")
+    p.add_argument("files", nargs="*", metavar="FILE")
+    p.set_defaults(func=cmd_cdc)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
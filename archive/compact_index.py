@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compact an index created by file_index.py.
+
+file_index.py appends a new row every time a file changes, so an index
+keeps the rows of every old version. Compaction sorts the index by path
+with a bounded-memory external merge sort and keeps only the last row
+appended for every path. With --prune-missing, paths that are no longer
+regular files are dropped too. The old index is kept as a backup. The
+input can be a CSV or a binary index, the output is CSV.
+"""
+
+import argparse
+import csv
+import itertools
+import os
+import time
+
+import index_format
+import index_sort
+
+
+def compact(rows, prune_missing=False, run_size=index_sort.RUN_SIZE, tmpdir=None):
+    """
+    Yield the newest row of every path, in path order. The sort is stable,
+    so the newest row is the last one of each group.
+    """
+    rows = index_sort.sort_rows(rows, index_sort.by_path, run_size, tmpdir)
+    for path, group in itertools.groupby(rows, key=index_sort.by_path):
+        for row in group:
+            pass
+        if prune_missing and not os.path.isfile(path):
+            continue
+        yield row
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Remove stale rows from an index file"
+    )
+    parser.add_argument(
+        "index",
+        nargs="?",
+        default="file_index",
+        help="Index file to compact. A backup file is created. "
+        "Default to file_index",
+    )
+    parser.add_argument(
+        "-o",
+        "--out",
+        help="Write the compacted index to this file instead of replacing the "
+        "index",
+    )
+    parser.add_argument(
+        "--prune-missing",
+        action="store_true",
+        help="Drop paths that are not regular files any more",
+    )
+    parser.add_argument(
+        "--run-size",
+        type=int,
+        default=index_sort.RUN_SIZE,
+        help="Number of rows sorted in memory at a time. Default to {}".format(
+            index_sort.RUN_SIZE
+        ),
+    )
+    parser.add_argument("--tmpdir", help="Directory for the temporary sort files")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    out_filename = args.out or "{}.compact-{}".format(args.index, stamp)
+
+    rows_in = 0
+    rows_out = 0
+
+    def counted(rows):
+        nonlocal rows_in
+        for rows_in, row in enumerate(rows, 1):
+            yield row
+
+    with open(out_filename, "w", newline="") as out_file:
+        writer = csv.writer(out_file)
+        for row in compact(
+            counted(index_format.read_index(args.index)),
+            args.prune_missing,
+            args.run_size,
+            args.tmpdir,
+        ):
+            writer.writerow(row)
+            rows_out += 1
+
+    size_in = os.path.getsize(args.index)
+    size_out = os.path.getsize(out_filename)
+    if not args.out:
+        os.rename(args.index, "{}.bak-{}".format(args.index, stamp))
+        os.rename(out_filename, args.index)
+
+    print(
+        """Counters:
+    Input rows:          {:12d}
+    Output rows:         {:12d}
+    Input MB:            {:12.1f}
+    Output MB:           {:12.1f}
+    Reduction:           {:11.1f}%
+    Time (s):            {:12.1f}""".format(
+            rows_in,
+            rows_out,
+            size_in / 1024**2,
+            size_out / 1024**2,
+            100 * (1 - size_out / size_in) if size_in else 0,
+            time.monotonic() - start,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,55 +1,844 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import errno
+import fcntl
+import hashlib
+import itertools
 import os
+import queue
+import re
 import shutil
-import csv
 import argparse
+import tempfile
+import threading
 import time
+from collections import OrderedDict, deque
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 
+import index_format
+import index_sort
+import iosched
+import merge_index
+import object_format
+import packs
+
+# raw SHA-1 -> [(path, mtime, size), ...]
 index = {}
 
+
+@dataclass
+class Counter:
+    copied = 0
+    copy_size = 0
+    exists = 0
+    failed = 0
+    # data of chunked files, and of their chunks that were not in the store
+    chunked_size = 0
+    new_chunk_size = 0
+    # error message -> hashes
+    errors: dict = field(default_factory=dict)
+    # copy method -> files
+    methods: dict = field(default_factory=dict)
+
+
+# (kind, key) -> semaphore limiting the copies per source device and
+# per destination
+slots = {}
+slots_lock = threading.Lock()
+# source device -> copies reading it or waiting for it
+busy = {}
+# paid for every read of a source
+budget = iosched.Budget()
+
+BUF_SIZE = 1024 * 1024
+# largest copy_file_range or sendfile call, the budget is paid per call
+KERNEL_CHUNK = 16 * BUF_SIZE
+# source paths whose os.stat() is cached
+STAT_CACHE = 65536
+# linux/fs.h
+FICLONE = 0x40049409
+# temporary file of an object being written, .<hash>.<random>
+TMP_NAME = re.compile(r'\.[0-9a-f]{40}\.')
+# seconds after which a temporary file is taken as left by a killed run
+STALE_TMP = 3600
+# errors that mean "this way of copying is not possible here"
+UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+        errno.ENOTTY, errno.EBADF}
+# errors of a copy that come from the destination
+DEST_ERRORS = {errno.ENOSPC, errno.EDQUOT, errno.EROFS, errno.EFBIG}
+
 def load_index(index_filename):
+    """
+    Add the rows of an index to index, keyed by raw SHA-1. The records of
+    a binary index are read undecoded, only the path is built as str.
+    """
 
     global index
 
-    with open(index_filename) as index_file:
-        reader = csv.reader(index_file)
-        for row in reader:
-            hash, mtime, size, path = row[:]
-            if hash not in index:
-                index[hash] = []
-            index[hash].append((path, mtime, size))
+    decode = index_format.decode
+    if index_format.is_binary(index_filename):
+        for digest, mtime, size, prefix, name in index_format.read_records(
+                index_filename):
+            sources = index.get(digest)
+            if sources is None:
+                sources = index[digest] = []
+            sources.append((decode(prefix + name), mtime, size))
+        return
+    for hash_, mtime, size, path in index_format.read_index(index_filename):
+        digest = bytes.fromhex(hash_)
+        sources = index.get(digest)
+        if sources is None:
+            sources = index[digest] = []
+        sources.append((path, mtime, size))
 
 
-def mkdir(out, hash):
-    dst = os.path.join(out,hash[0:2],hash[2:4])
-    if os.path.isdir(dst):
-        return
-    if args.v:
-        print("D: Makedir {}".format(dst))
-    os.makedirs(dst)
+def stream_groups(paths):
+    """
+    Yield (digest, [(path, mtime, size), ...]) one raw SHA-1 at a time.
+    Indexes that are not sorted by hash are sorted with an external merge
+    sort first, so memory is bounded by args.run_size rows whatever the size
+    of the indexes.
+    """
 
-def copy_file(hash_, out):
+    rows = merge_index.merge(paths, args.sorted, args.run_size, args.tmpdir)
+    for hash_, group in itertools.groupby(rows, key=index_sort.by_hash):
+        yield bytes.fromhex(hash_), [(path, mtime, size)
+                for _, mtime, size, path in group]
 
-    # Get list of files with the same hash ordered by -mtime
-    for (path, mtime, size) in sorted(index[hash_], key=lambda x:x[1], reverse=True):
+
+class Store:
+    """
+    An archive store with objects in out/xx/yy/<hash>, its inventory and
+    its counters.
+    """
+
+    def __init__(self, out, inventory_file=None):
+        self.out = out
+        # a new store starts empty
+        os.makedirs(out, exist_ok=True)
+        self.dev = os.stat(out).st_dev
+        self.inventory_file = inventory_file
+        self.counter = Counter()
+        self.lock = threading.Lock()
+        # raw SHA-1 of the chunks being written -> event set when done
+        self.writing = {}
+        self.packs = packs.PackWriter(out) if args.pack_below else None
+        # raw SHA-1 of the objects in the store and the xx/yy dirs of the
+        # store
+        self.inventory = set()
+        self.dirs = set()
+
+    def path(self, hash_):
+        return os.path.join(self.out, hash_[0:2], hash_[2:4], hash_)
+
+    def exists(self, hash_):
+        path = self.path(hash_)
+        return os.path.isfile(path) or any(os.path.isfile(path + suffix)
+                for suffix in object_format.SUFFIXES)
+
+    def write(self, hash_, data, suffix=''):
+        """ Write a small object through a temporary file """
+
+        self.mkdir(hash_)
+        dst = self.path(hash_) + suffix
+        fd, tmp = tempfile.mkstemp(prefix='.{}.'.format(hash_),
+                dir=os.path.dirname(dst))
         try:
-            stat = os.stat(path)
-        except FileNotFoundError:
-            continue
-        if int(stat.st_mtime) == int(mtime) and stat.st_size == int(size):
-            dst = os.path.join(out, hash_[0:2], hash_[2:4], hash_)
-            mkdir(out, hash_)
-            if os.path.isfile(dst):
-                if args.v:
-                    print("D: Exists {}".format(hash_))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, dst)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def add_chunk(self, digest, data):
+        """
+        Store a chunk unless the store has it. Return the bytes written.
+        A chunk written by another thread is waited for, as the manifest
+        must not be written before its chunks.
+        """
+
+        while True:
+            with self.lock:
+                if digest in self.inventory:
+                    return 0
+                writing = self.writing.get(digest)
+                if writing is None:
+                    writing = self.writing[digest] = threading.Event()
+                    break
+            # if the other thread failed, try again
+            writing.wait()
+        hash_ = digest.hex()
+        try:
+            if self.exists(hash_):
+                written = 0
+            elif args.compress and object_format.compresses(
+                    data[:object_format.CHUNK_SIZE], args.compress):
+                self.write(hash_, object_format.compress_bytes(data,
+                    args.compress), object_format.SUFFIX)
+                written = len(data)
+            else:
+                self.write(hash_, data)
+                written = len(data)
+            self.inventory.add(digest)
+        finally:
+            with self.lock:
+                del self.writing[digest]
+            writing.set()
+        return written
+
+    def count_chunks(self, size, new_size):
+        with self.lock:
+            self.counter.chunked_size += size
+            self.counter.new_chunk_size += new_size
+
+    def scan(self):
+        """
+        Find the objects in the store with one scandir pass over its xx/yy
+        fan-out and in the indexes of its packs, so that archived hashes
+        are skipped without any stat. Temporary files left by a killed run
+        are removed on the way.
+        """
+
+        self.inventory.update(packs.Packs(self.out).objects)
+
+        with os.scandir(self.out) as level1:
+            for d1 in level1:
+                if len(d1.name) != 2 or not d1.is_dir():
+                    continue
+                with os.scandir(d1.path) as level2:
+                    for d2 in level2:
+                        if len(d2.name) != 2 or not d2.is_dir():
+                            continue
+                        self.dirs.add(d1.name + d2.name)
+                        with os.scandir(d2.path) as objects:
+                            for f in objects:
+                                if len(f.name) == 40 or (f.name[40:] in
+                                        object_format.SUFFIXES):
+                                    self.inventory.add(
+                                            bytes.fromhex(f.name[:40]))
+                                elif TMP_NAME.match(f.name):
+                                    self.remove_stale(f)
+
+    def remove_stale(self, entry):
+        """
+        Remove a temporary file unless it was written recently: another run
+        may be copying to the store.
+        """
+
+        try:
+            if time.time() - entry.stat().st_mtime < STALE_TMP:
                 return
+            os.unlink(entry.path)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            print("W: Cannot remove {}: {}".format(entry.path, e.strerror))
+            return
+        if args.v:
+            print("D: Removed stale {}".format(entry.path))
+
+    def load_inventory(self):
+        """
+        Load the inventory file, if given and present, or scan the store.
+        """
+
+        if self.inventory_file and os.path.isfile(self.inventory_file):
+            with open(self.inventory_file, 'rb') as f:
+                data = f.read()
+            self.inventory.update(data[i:i + 20]
+                    for i in range(0, len(data), 20))
+            self.dirs.update(h[:2].hex() for h in self.inventory)
+            return
+        self.scan()
+
+    def close(self):
+        if self.packs:
+            self.packs.close()
+            # packed objects counted as copied, whose pack entry was lost
+            for digest, _, length in self.packs.lost:
+                self.inventory.discard(digest)
+                self.counter.copied -= 1
+                self.counter.copy_size -= length
+                self.counter.methods['pack'] -= 1
+                self.record(digest.hex(), 'error', 0, 'pack index lost')
+        self.save_inventory()
+
+    def save_inventory(self):
+        if not self.inventory_file:
+            return
+        tmp = self.inventory_file + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(b''.join(sorted(self.inventory)))
+        os.rename(tmp, self.inventory_file)
+
+    def mkdir(self, hash_):
+        if hash_[0:4] in self.dirs:
+            return
+        dst = os.path.dirname(self.path(hash_))
+        if args.v:
+            print("D: Makedir {}".format(dst))
+        os.makedirs(dst, exist_ok=True)
+        self.dirs.add(hash_[0:4])
+
+    def record(self, hash_, status, size, detail):
+        """ Add the result of a copy to the counters """
+
+        counter = self.counter
+        if status == 'copied':
+            counter.copied += 1
+            counter.copy_size += size
+            self.inventory.add(bytes.fromhex(hash_))
+            counter.methods[detail] = counter.methods.get(detail, 0) + 1
+        elif status == 'exists':
+            counter.exists += 1
+        else:
+            counter.failed += 1
+            counter.errors.setdefault(detail, []).append(hash_)
             if args.v:
-                print("D: Copy {} from {}".format(hash_, path))
-            shutil.copyfile(path, dst)
+                print("E: {} {} in {}".format(hash_, detail, self.out))
+
+
+def slot(kind, key, limit):
+    """ Return the semaphore that limits concurrent copies for a key """
+
+    with slots_lock:
+        if (kind, key) not in slots:
+            slots[(kind, key)] = threading.BoundedSemaphore(limit)
+        return slots[(kind, key)]
+
+
+@contextmanager
+def reading(dev):
+    """ Take a read slot of a source device, counting it as busy """
+
+    with slots_lock:
+        busy[dev] = busy.get(dev, 0) + 1
+    try:
+        with slot('dev', dev, args.per_device):
+            yield
+    finally:
+        with slots_lock:
+            busy[dev] -= 1
+
+
+class SourceStats:
+    """
+    Cache of os.stat() of the source files, shared by the worker threads.
+    Append-only indexes list a path again for each of its old hashes, so
+    the same path is a source of many hashes. The last STAT_CACHE paths
+    are kept, missing and unreadable ones too.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # path -> stat, None if missing or unreadable
+        self.stats = OrderedDict()
+
+    def stat(self, path):
+        """ Cached os.stat() of path, None if it is missing or unreadable """
+
+        with self.lock:
+            if path in self.stats:
+                self.stats.move_to_end(path)
+                return self.stats[path]
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        with self.lock:
+            self.stats[path] = st
+            if len(self.stats) > STAT_CACHE:
+                self.stats.popitem(last=False)
+        return st
+
+
+source_stats = SourceStats()
+
+
+def candidates(sources, stores):
+    """
+    Return the sources that exist, best first: on the device of a store,
+    where a reflink is possible, then on the least busy device, then the
+    newest.
+    """
+
+    devs = {store.dev for store in stores}
+    found = []
+    for path, mtime, size in sources:
+        st = source_stats.stat(path)
+        if st is not None:
+            found.append((st.st_dev not in devs, busy.get(st.st_dev, 0),
+                -int(mtime), path, mtime, size))
+    found.sort()
+    return [(path, mtime, size) for *_, path, mtime, size in found]
+
+
+def _copy_file_range(fsrc, fdst, size):
+    offset = 0
+    while offset < size:
+        n = os.copy_file_range(fsrc, fdst, min(size - offset, KERNEL_CHUNK),
+                offset, offset)
+        if n == 0:
+            break
+        budget.acquire(n)
+        offset += n
+
+
+def _sendfile(fsrc, fdst, size):
+    offset = 0
+    while offset < size:
+        n = os.sendfile(fdst, fsrc, offset, min(size - offset, KERNEL_CHUNK))
+        if n == 0:
+            break
+        budget.acquire(n)
+        offset += n
+
+
+def _hash_copy(fsrc, fdst):
+    h = hashlib.sha1()
+    while True:
+        buf = fsrc.read(BUF_SIZE)
+        if not buf:
+            return h.hexdigest()
+        h.update(buf)
+        fdst.write(buf)
+
+
+def _hash_file(f):
+    h = hashlib.sha1()
+    f.seek(0)
+    while True:
+        buf = f.read(BUF_SIZE)
+        if not buf:
+            return h.hexdigest()
+        h.update(buf)
+
+
+def _copy(fsrc, fdst, verify):
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        # the clone shares the extents of the source, hashing it is the
+        # only read of the data
+        return 'reflink', _hash_file(budget.file(fdst)) if verify else None
+    except OSError as e:
+        if e.errno not in UNSUPPORTED:
+            raise
+    if verify:
+        return 'copy', _hash_copy(fsrc, fdst)
+    size = os.fstat(fsrc.fileno()).st_size
+    for method, func in (('copy_file_range', _copy_file_range),
+            ('sendfile', _sendfile)):
+        try:
+            func(fsrc.fileno(), fdst.fileno(), size)
+            return method, None
+        except OSError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+            fdst.truncate(0)
+    fsrc.seek(0)
+    fdst.seek(0)
+    shutil.copyfileobj(fsrc, fdst, BUF_SIZE)
+    return 'copy', None
+
+
+def copy_data(src, dst, verify=True):
+    """
+    Copy src to dst with the cheapest method that works: a reflink clone
+    (FICLONE), os.copy_file_range, os.sendfile and only then a copy through
+    user space. With verify, the data is hashed on the way: a clone is
+    hashed after cloning, anything else is copied through user space while
+    hashing, as the kernel copies never show the data. dst is fsync'ed.
+    Return the name of the method and the SHA-1 (None without verify).
+    """
+
+    with open(src, 'rb') as fsrc, open(dst, 'w+b') as fdst:
+        method, digest = _copy(budget.file(fsrc), fdst, verify)
+        fdst.flush()
+        os.fsync(fdst.fileno())
+    return method, digest
+
+
+class Writer(threading.Thread):
+    """
+    Write a new object to a store. The data comes from a bounded queue of
+    args.buffers buffers, so a slow store makes the reader wait only when
+    it lags that far behind. Files up to one buffer are written by the
+    reader itself, without a thread.
+    """
+
+    def __init__(self, store, hash_, size, suffix=''):
+        super().__init__(daemon=True)
+        self.store = store
+        self.dst = store.path(hash_) + suffix
+        self.error = None
+        self.queue = queue.Queue(args.buffers)
+        self.threaded = size > BUF_SIZE
+        fd, self.tmp = tempfile.mkstemp(prefix='.{}.'.format(hash_),
+                dir=os.path.dirname(self.dst))
+        self.file = os.fdopen(fd, 'wb')
+        if self.threaded:
+            self.start()
+
+    def _write(self, buf):
+        if self.error is None:
+            try:
+                self.file.write(buf)
+            except OSError as e:
+                self.error = e
+
+    def run(self):
+        while True:
+            buf = self.queue.get()
+            if buf is None:
+                return
+            self._write(buf)
+
+    def put(self, buf):
+        if self.error is not None:
+            return
+        if self.threaded:
+            self.queue.put(buf)
+        else:
+            self._write(buf)
+
+    def finish(self):
+        """ Wait for the data to be written and fsync it """
+
+        if self.threaded:
+            self.queue.put(None)
+            self.join()
+        try:
+            if self.error is None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            self.file.close()
+        except OSError as e:
+            self.error = self.error or e
+
+    def commit(self):
+        try:
+            os.rename(self.tmp, self.dst)
+        except OSError as e:
+            self.error = e
+            self.discard()
+
+    def discard(self):
+        if os.path.exists(self.tmp):
+            os.unlink(self.tmp)
+
+
+def copy_single(hash_, path, stat, store):
+    """
+    Copy path to one store with copy_data(). Return the method, the SHA-1
+    of the data (None without verify) and {store: exception} if the store
+    failed. Errors on the temporary file are the store's. The kernel copies
+    report an error of either file without a name, it is put on the store
+    for a full or read-only file system (DEST_ERRORS) and otherwise taken
+    as an error reading path, which is raised.
+    """
+
+    try:
+        fd, tmp = tempfile.mkstemp(prefix='.{}.'.format(hash_),
+                dir=os.path.dirname(store.path(hash_)))
+        os.close(fd)
+    except OSError as e:
+        return 'copy', None, {store: e}
+    try:
+        with reading(stat.st_dev), \
+                slot('dest', store.out, args.per_dest):
+            method, digest = copy_data(path, tmp, args.verify)
+        if digest is None or digest == hash_:
+            os.rename(tmp, store.path(hash_))
+    except OSError as e:
+        if e.filename != tmp and e.errno not in DEST_ERRORS:
+            raise
+        return 'copy', None, {store: e}
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+    return method, digest, {}
+
+
+def copy_packed(hash_, path, stat, stores):
+    """
+    Read a small file and append it to the packs of the stores if its
+    SHA-1 matches. Return 'pack', the SHA-1 of the data and {store:
+    exception} for the stores that failed. Errors reading path are raised.
+    """
+
+    with reading(stat.st_dev):
+        with open(path, 'rb') as f:
+            data = budget.file(f).read()
+    digest = hashlib.sha1(data).hexdigest()
+    failed = {}
+    if digest == hash_:
+        for store in stores:
+            try:
+                store.packs.add(bytes.fromhex(hash_), data)
+            except OSError as e:
+                failed[store] = e
+    return 'pack', digest, failed
+
+
+def read_chunks(f, h):
+    while True:
+        buf = f.read(BUF_SIZE)
+        if not buf:
             return
-    print("E: {} not found!".format(hash_))
+        h.update(buf)
+        yield buf
+
+
+def copy_chunked(hash_, path, stat, stores):
+    """
+    Cut a large file in content defined chunks, store the chunks that the
+    stores lack and, if the SHA-1 of the file matches, a manifest of the
+    chunks. Return 'chunked', the SHA-1 of the data and {store: exception}
+    for the stores that failed. Errors reading path are raised. Chunks
+    written before a mismatch are kept: they are valid objects.
+    """
+
+    failed = {}
+    new_size = dict.fromkeys(stores, 0)
+    entries = []
+    h = hashlib.sha1()
+    with ExitStack() as stack:
+        stack.enter_context(reading(stat.st_dev))
+        for store in stores:
+            stack.enter_context(slot('dest', store.out, args.per_dest))
+        with open(path, 'rb') as f:
+            for chunk in object_format.cdc_chunks(budget.file(f)):
+                h.update(chunk)
+                digest = hashlib.sha1(chunk).digest()
+                entries.append((digest, len(chunk)))
+                for store in stores:
+                    if store in failed:
+                        continue
+                    try:
+                        new_size[store] += store.add_chunk(digest, chunk)
+                    except OSError as e:
+                        failed[store] = e
+        digest = h.hexdigest()
+        if digest == hash_:
+            manifest = object_format.manifest(entries)
+            for store in stores:
+                if store in failed:
+                    continue
+                try:
+                    store.write(hash_, manifest,
+                            object_format.MANIFEST_SUFFIX)
+                except OSError as e:
+                    failed[store] = e
+                    continue
+                store.count_chunks(stat.st_size, new_size[store])
+    return 'chunked', digest, failed
+
+
+def copy_multi(hash_, path, stat, stores, compress=None):
+    """
+    Read path once and write it to all the stores, hashing the data on the
+    way. With compress, the name of an algorithm of object_format.py, the
+    stores get a compressed object if the first chunk of the data
+    compresses well enough, else the data as it is. Return the method, the
+    SHA-1 of the data and {store: exception} for the stores that failed.
+    Errors reading path are raised.
+    """
+
+    with ExitStack() as stack:
+        stack.enter_context(reading(stat.st_dev))
+        # always in the same order, so that copies cannot deadlock
+        for store in stores:
+            stack.enter_context(slot('dest', store.out, args.per_dest))
+        f = budget.file(stack.enter_context(open(path, 'rb')))
+        h = hashlib.sha1()
+        suffix = ''
+        pieces = read_chunks(f, h)
+        if compress:
+            head = f.read(object_format.CHUNK_SIZE)
+            if object_format.compresses(head, compress):
+                suffix = object_format.SUFFIX
+                pieces = object_format.encode(f, compress, h, head=head)
+            else:
+                compress = None
+                h.update(head)
+                pieces = itertools.chain((head,), pieces)
+        writers = []
+        failed = {}
+        done = False
+        try:
+            for store in stores:
+                try:
+                    writers.append(Writer(store, hash_, stat.st_size,
+                        suffix))
+                except OSError as e:
+                    failed[store] = e
+            for buf in pieces:
+                for w in writers:
+                    w.put(buf)
+            done = True
+        finally:
+            for w in writers:
+                w.finish()
+                if not done:
+                    w.discard()
+        digest = h.hexdigest()
+        for w in writers:
+            if w.error is None and digest == hash_:
+                w.commit()
+            else:
+                w.discard()
+            if w.error is not None:
+                failed[w.store] = w.error
+    return compress or 'copy', digest, failed
+
+
+def describe(e):
+    return '{}: {}'.format(type(e).__name__, e.strerror)
+
+
+def copy_file(hash_, sources, stores):
+    """
+    Copy one of the sources of a hash to the stores that lack it. Runs on
+    the worker threads. The data goes to a temporary file next to the
+    object, which is renamed to the object only when its SHA-1 matches,
+    otherwise the next source is tried. A crash never leaves a partial
+    object in a store. A source is read once for all the stores, see
+    copy_multi(). Return {store: result}, where a result is ('exists', 0,
+    ''), ('copied', size, method) or ('error', 0, message).
+    """
+
+    results = {}
+    targets = []
+    for store in stores:
+        try:
+            store.mkdir(hash_)
+        except OSError as e:
+            results[store] = ('error', 0, describe(e))
+            continue
+        if store.exists(hash_):
+            if args.v:
+                print("D: Exists {} in {}".format(hash_, store.out))
+            results[store] = ('exists', 0, '')
+        else:
+            targets.append(store)
+    error = 'not found'
+    for (path, mtime, size) in candidates(sources, targets):
+        if not targets:
+            break
+        stat = source_stats.stat(path)
+        if stat is None:
+            continue
+        if int(stat.st_mtime) != int(mtime) or stat.st_size != int(size):
+            continue
+        try:
+            if stat.st_size < args.pack_below:
+                method, digest, failed = copy_packed(hash_, path, stat,
+                        targets)
+            elif args.chunk_above and stat.st_size >= args.chunk_above:
+                method, digest, failed = copy_chunked(hash_, path, stat,
+                        targets)
+            elif args.compress:
+                method, digest, failed = copy_multi(hash_, path, stat,
+                        targets, args.compress)
+            elif len(targets) == 1:
+                method, digest, failed = copy_single(hash_, path, stat,
+                        targets[0])
+            else:
+                method, digest, failed = copy_multi(hash_, path, stat,
+                        targets)
+        except OSError as e:
+            # an unreadable source, try the next one
+            error = describe(e)
+            continue
+        for store, e in failed.items():
+            results[store] = ('error', 0, describe(e))
+            targets.remove(store)
+        if digest is not None and digest != hash_:
+            error = 'hash mismatch'
+            if args.v:
+                print("W: {} has changed, its SHA-1 is {}".format(
+                    path, digest))
+            continue
+        for store in targets:
+            if args.v:
+                print("D: Copy {} from {} to {} ({})".format(hash_, path,
+                    store.out, method))
+            results[store] = ('copied', stat.st_size, method)
+        return results
+    for store in targets:
+        results[store] = ('error', 0, error)
+    return results
+
+
+def record(hash_, future):
+    """ Add the results of a copy to the counters of the stores """
+
+    for store, result in future.result().items():
+        store.record(hash_, *result)
+
+
+def copy_all(groups, stores):
+    """
+    Copy the groups of (raw SHA-1, sources) on a pool of args.jobs threads.
+    Results are collected in submission order, with at most jobs * 4 copies
+    in flight. Hashes in the inventory of a store are skipped for that store
+    before their sources are looked at.
+    """
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        for digest, sources in groups:
+            h = digest.hex()
+            targets = []
+            for store in stores:
+                if digest in store.inventory:
+                    store.counter.exists += 1
+                else:
+                    targets.append(store)
+            if not targets:
+                continue
+            pending.append((h, pool.submit(copy_file, h, sources, targets)))
+            while len(pending) > args.jobs * 4:
+                record(*pending.popleft())
+        while pending:
+            record(*pending.popleft())
+
+
+def print_summary(stores, seconds):
+    for store in stores:
+        counter = store.counter
+        if len(stores) == 1:
+            print("Counters:")
+        else:
+            print("Counters for {}:".format(store.out))
+        print("""    Copied files:        {:12d}
+    Copied MB:           {:12.0f}
+    Copy MB/s:           {:12.1f}
+    Already archived:    {:12d}
+    Failed hashes:       {:12d}""".format(
+            counter.copied,
+            counter.copy_size / 1024**2,
+            counter.copy_size / 1024**2 / max(seconds, 1e-9),
+            counter.exists,
+            counter.failed))
+        for method, files in sorted(counter.methods.items()):
+            print("    {:21s}{:12d}".format(method + ':', files))
+        if counter.chunked_size:
+            print("""    Chunked MB:          {:12.0f}
+    New chunks MB:       {:12.0f}
+    Dedup ratio:         {:12.2f}""".format(
+                counter.chunked_size / 1024**2,
+                counter.new_chunk_size / 1024**2,
+                counter.chunked_size / max(counter.new_chunk_size, 1)))
+        for error, hashes in sorted(counter.errors.items()):
+            print("E: {} hashes: {} e.g. {}".format(len(hashes), error,
+                ' '.join(hashes[:3])))
 
 
 def copy_index(out):
@@ -65,26 +854,94 @@ def copy_index(out):
 
 def main():
     global args
+    global budget
     global index
 
     parser = argparse.ArgumentParser(
             description='Copy indexed files to the archive')
-    parser.add_argument('--out', help="Output directory")
+    parser.add_argument('--out', action='append', required=True,
+            help="Output directory. Repeat it to copy to several stores:"
+            " every source file is read once for all of them.")
     parser.add_argument('index', nargs='+',
             help='One or more index files to be processed. Each file listed '
             'in any of the indexes will be copied.')
     parser.add_argument('-s', '--source', help='Source name. Index file will be'
             ' copied with this name in the target dir. If not provided,'
             ' index file will not be copied. Typically this is the hostname.')
+    parser.add_argument('--sorted', action='store_true',
+            help='The indexes are sorted by hash, e.g. catalogs written by'
+            ' merge_index.py or shards written by file_index.py --shards.'
+            ' They are read one hash at a time instead of being loaded.')
+    parser.add_argument('--stream', action='store_true',
+            help='Do not load the indexes. Indexes not sorted by hash are'
+            ' sorted on disk and all of them are read one hash at a time.'
+            ' Paths listed in several indexes are tried once.')
+    parser.add_argument('--run-size', type=int, default=index_sort.RUN_SIZE,
+            help='Number of rows sorted in memory at a time with --stream.'
+            ' Default to {}'.format(index_sort.RUN_SIZE))
+    parser.add_argument('--tmpdir',
+            help='Directory for the temporary sort files of --stream')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help='Number of files copied in parallel. Default to 1')
+    parser.add_argument('--per-device', type=int, default=2,
+            help='Maximum parallel copies reading from one source device.'
+            ' Default to 2')
+    parser.add_argument('--per-dest', type=int, default=4,
+            help='Maximum parallel copies writing to one destination.'
+            ' Default to 4')
+    parser.add_argument('--inventory', action='append', default=[],
+            help='File with the hashes in the store. It is read instead of'
+            ' scanning the store and updated at the end. Use it only if'
+            ' nothing else writes to the store. Repeat it for each --out,'
+            ' in the same order.')
+    parser.add_argument('--buffers', type=int, default=16,
+            help='With several --out, how many 1 MiB buffers a store may'
+            ' lag behind the reading of a file. Default to 16')
+    parser.add_argument('--no-verify', dest='verify', action='store_false',
+            help='Do not hash the data while copying. Allows the kernel'
+            ' copies, copy_file_range and sendfile, for files that cannot be'
+            ' cloned, but trusts that a source with the indexed mtime and'
+            ' size has the indexed content.')
+    parser.add_argument('--pack-below', type=int, default=0, metavar='SIZE',
+            help='Append files smaller than SIZE bytes to the pack files of'
+            ' the store instead of creating an object file for each, see'
+            ' packs.py. Default to 0, no packs')
+    parser.add_argument('--compress',
+            choices=sorted(object_format.ALGORITHMS),
+            help='Store compressed objects, xx/yy/<hash>.z, for files whose'
+            ' first {} KiB compress, see object_format.py'.format(
+                object_format.CHUNK_SIZE // 1024))
+    parser.add_argument('--chunk-above', type=int, default=0, metavar='SIZE',
+            help='Cut files of SIZE bytes or more in content defined chunks,'
+            ' stored once across all files, see object_format.py. Default'
+            ' to 0, no chunks')
+    iosched.add_arguments(parser)
     parser.add_argument('-v', action='count', default=0,
             help='verbose')
 
     args = parser.parse_args()
+    if len(args.inventory) > len(args.out):
+        parser.error('more --inventory than --out')
+    budget = iosched.from_args(args)
 
-    for idx_file in args.index:
-        load_index(idx_file)
-    for h in index:
-        copy_file(h, args.out)
+    start = time.monotonic()
+    stores = [Store(out, inventory) for out, inventory in
+            itertools.zip_longest(args.out, args.inventory)]
+    for store in stores:
+        store.load_inventory()
+    if args.stream:
+        groups = stream_groups(args.index)
+    elif args.sorted:
+        groups = ((bytes.fromhex(h), sources) for h, sources in
+                index_sort.hash_groups(args.index))
+    else:
+        for idx_file in args.index:
+            load_index(idx_file)
+        groups = index.items()
+    copy_all(groups, stores)
+    for store in stores:
+        store.close()
+    print_summary(stores, time.monotonic() - start)
 
     #copy_index(args.out)
 
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Show what changed between two index snapshots, e.g. two
+file_index.bak-<timestamp> files.
+
+Both indexes are reduced to the newest row per path and sorted by path
+with an external merge sort, then compared with a sort-merge join, so
+memory stays bounded whatever their size. The changes are written as CSV:
+
+    status,sha1,mtime,size,path[,old path]
+
+A  path is new
+R  path is removed
+M  path has new content
+V  content is moved: a removed path had the same hash
+
+file_index.py never drops the rows of deleted files, so removed paths
+show up only if the new index was compacted with --prune-missing, or
+with --prune-missing here, which checks the paths of the new index on
+disk.
+
+With --new-index, the rows of the new index whose hash is not in the old
+index at all are written in index format, sorted by hash. Passing that
+file to copy_files.py (with --sorted) archives only the new content.
+"""
+
+import argparse
+import csv
+import sys
+import tempfile
+
+import compact_index
+import index_format
+import index_sort
+
+
+def spool():
+    f = tempfile.TemporaryFile("w+", newline="")
+    return f, csv.writer(f)
+
+
+def rewind(f):
+    f.seek(0)
+    return csv.reader(f)
+
+
+def compacted(path, args, prune_missing=False):
+    rows = index_format.read_index(path)
+    return compact_index.compact(rows, prune_missing, args.run_size, args.tmpdir)
+
+
+def diff(args, out, counts):
+    """Write the changes between args.old and args.new to the csv writer out."""
+
+    def by_hash(rows):
+        return index_sort.sort_rows(
+            rows, index_sort.by_hash, args.run_size, args.tmpdir
+        )
+
+    added_file, added = spool()
+    removed_file, removed = spool()
+    content_file, content = spool()
+
+    # paths: modified rows are written at once, added and removed ones are
+    # kept for the move detection
+    for _, old, new in index_sort.join(
+        compacted(args.old, args),
+        compacted(args.new, args, args.prune_missing),
+        index_sort.by_path,
+    ):
+        if not old:
+            added.writerow(new[0])
+            content.writerow(new[0])
+        elif not new:
+            removed.writerow(old[0])
+        elif old[0][0] != new[0][0]:
+            out.writerow(["M"] + new[0])
+            counts["M"] += 1
+            content.writerow(new[0])
+
+    # moves: a removed and an added path with the same hash
+    for _, old, new in index_sort.join(
+        by_hash(rewind(removed_file)), by_hash(rewind(added_file)), index_sort.by_hash
+    ):
+        for old_row, new_row in zip(old, new):
+            out.writerow(["V"] + new_row + [old_row[3]])
+            counts["V"] += 1
+        for row in new[len(old) :]:
+            out.writerow(["A"] + row)
+            counts["A"] += 1
+        for row in old[len(new) :]:
+            out.writerow(["R"] + row)
+            counts["R"] += 1
+    added_file.close()
+    removed_file.close()
+
+    # new content: added and modified rows whose hash is not in the old index
+    if args.new_index:
+        with open(args.new_index, "w", newline="") as f:
+            writer = csv.writer(f)
+            for _, old, new in index_sort.join(
+                by_hash(index_format.read_index(args.old)),
+                by_hash(rewind(content_file)),
+                index_sort.by_hash,
+            ):
+                if not old:
+                    writer.writerows(new)
+                    counts["new hashes"] += 1
+    content_file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Show the differences between two index files"
+    )
+    parser.add_argument("old", help="Old index file, CSV or binary")
+    parser.add_argument("new", help="New index file, CSV or binary")
+    parser.add_argument("-o", "--out", help="Write the changes here, not to stdout")
+    parser.add_argument(
+        "--new-index",
+        metavar="FILE",
+        help="Write the rows with hashes that are not in the old index to FILE",
+    )
+    parser.add_argument(
+        "--prune-missing",
+        action="store_true",
+        help="Treat paths of the new index that are not regular files any "
+        "more as removed",
+    )
+    parser.add_argument(
+        "--run-size",
+        type=int,
+        default=index_sort.RUN_SIZE,
+        help="Number of rows sorted in memory at a time. Default to {}".format(
+            index_sort.RUN_SIZE
+        ),
+    )
+    parser.add_argument("--tmpdir", help="Directory for the temporary sort files")
+    args = parser.parse_args()
+
+    counts = dict.fromkeys(("A", "R", "M", "V", "new hashes"), 0)
+    if args.out:
+        with open(args.out, "w", newline="") as f:
+            diff(args, csv.writer(f), counts)
+    else:
+        diff(args, csv.writer(sys.stdout), counts)
+
+    print(
+        "Added: {A}  Removed: {R}  Modified: {M}  Moved: {V}  "
+        "New hashes: {new hashes}".format(**counts),
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,16 +3,173 @@
 
 
 import argparse
+import bisect
+import contextlib
 import csv
+import errno
+import fcntl
+import fnmatch
+import functools
+import glob
 import hashlib
+import heapq
+import json
 import os
+import re
 import shutil
-import subprocess
+import struct
 import sys
+import threading
 import time
+from array import array
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
+from datetime import timedelta
 
-index = set()
+import index_format
+import index_sort
+
+BLOCK_SIZE = 1024 * 1024
+
+# struct fiemap and struct fiemap_extent from linux/fiemap.h
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP = struct.Struct("=QQLLLL")
+FIEMAP_EXTENT = struct.Struct("=QQQQQLLLL")
+
+# extended attribute with "sha1:mtime:size" of a file, set with --xattr
+XATTR = "user.file_index.sha1"
+
+
+class FingerprintSet:
+    """
+    Set of 64-bit fingerprints of str or bytes keys, kept in a sorted
+    array. An entry costs 8 bytes instead of 100+ for a Python set of
+    digests.
+
+    Keys are collected in runs of RUN_SIZE that are sorted on their own.
+    freeze() merges the runs into the table and must be called before the
+    set is queried. Lookups are binary searches. A changed file is taken for
+    an indexed one only if its fingerprint collides with one of the table,
+    which has a probability of about len(self) / 2**64 per lookup.
+    """
+
+    RUN_SIZE = 1 << 20
+
+    def __init__(self):
+        self.table = array("Q")
+        self.runs = []
+        self.pending = []
+
+    @staticmethod
+    def fingerprint(key):
+        if isinstance(key, str):
+            key = index_format.encode(key)
+        digest = hashlib.blake2b(key, digest_size=8).digest()
+        return int.from_bytes(digest, "little")
+
+    def add(self, key):
+        self.pending.append(self.fingerprint(key))
+        if len(self.pending) >= self.RUN_SIZE:
+            self._flush()
+
+    def update(self, keys):
+        """Add many bytes keys, without a method call per key."""
+        blake2b = hashlib.blake2b
+        from_bytes = int.from_bytes
+        pending = self.pending
+        for key in keys:
+            pending.append(from_bytes(blake2b(key, digest_size=8).digest(), "little"))
+            if len(pending) >= self.RUN_SIZE:
+                self._flush()
+                pending = self.pending
+
+    def _flush(self):
+        self.runs.append(array("Q", sorted(set(self.pending))))
+        self.pending = []
+
+    def freeze(self):
+        if self.pending:
+            self._flush()
+        if not self.runs:
+            return
+        if not self.table and len(self.runs) == 1:
+            # a run is sorted and has no duplicates
+            self.table = self.runs.pop()
+            return
+        table = array("Q")
+        last = None
+        for fp in heapq.merge(self.table, *self.runs):
+            if fp != last:
+                table.append(fp)
+                last = fp
+        self.table = table
+        self.runs = []
+
+    def __contains__(self, key):
+        fp = self.fingerprint(key)
+        i = bisect.bisect_left(self.table, fp)
+        return i < len(self.table) and self.table[i] == fp
+
+    def __len__(self):
+        return len(self.table)
+
+
+class FingerprintMap(FingerprintSet):
+    """
+    FingerprintSet that maps every key to a SHA-1. The raw digests are kept
+    in a bytes table parallel to the fingerprints, 28 bytes per entry.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.values = b""
+
+    def add(self, key, hash_):
+        self.pending.append((self.fingerprint(key), bytes.fromhex(hash_)))
+        if len(self.pending) >= self.RUN_SIZE:
+            self._flush()
+
+    def _flush(self):
+        self.pending.sort()
+        fps = array("Q", (fp for fp, _ in self.pending))
+        values = b"".join(v for _, v in self.pending)
+        self.runs.append((fps, values))
+        self.pending = []
+
+    @staticmethod
+    def _items(fps, values):
+        for i, fp in enumerate(fps):
+            yield fp, values[i * 20 : i * 20 + 20]
+
+    def freeze(self):
+        if self.pending:
+            self._flush()
+        if not self.runs:
+            return
+        table = array("Q")
+        values = bytearray()
+        runs = [self._items(self.table, self.values)]
+        runs.extend(self._items(fps, v) for fps, v in self.runs)
+        for fp, value in heapq.merge(*runs, key=lambda item: item[0]):
+            if not table or table[-1] != fp:
+                table.append(fp)
+                values += value
+        self.table = table
+        self.values = bytes(values)
+        self.runs = []
+
+    def get(self, key):
+        """Return the hex SHA-1 stored for key or None."""
+        fp = self.fingerprint(key)
+        i = bisect.bisect_left(self.table, fp)
+        if i < len(self.table) and self.table[i] == fp:
+            return self.values[i * 20 : i * 20 + 20].hex()
+        return None
+
+
+index = FingerprintSet()
+inodes = FingerprintMap()
 
 
 @dataclass
@@ -23,16 +180,47 @@ class Counter:
     files_hash = 0
     files_err = 0
     hash_size = 0
+    files_moved = 0
+    moved_size = 0
+    files_linked = 0
+    linked_size = 0
+    hash_time = 0.0
+    files_xattr = 0
+    xattr_size = 0
+    dirs_pruned = 0
+    files_pruned = 0
+    pruned_size = 0
+    dirs_pending = 0
+    queued_size = 0
+    seek_scan = 0
+    seek_sorted = 0
 
 
 counter = Counter()
 
+# devices where xattrs can not be read or written
+no_xattr_devs = set()
+
+# wall time of the phases of the run in seconds
+phases = {}
+
+
+@contextlib.contextmanager
+def phase(name):
+    global phases
+
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        phases[name] = phases.get(name, 0.0) + time.monotonic() - start
+
 
 def load_index(path):
     """
     Load an index file. This data is later used to check if the file
     has changed and needs to be hashed. Stores only the minimum information
-    needed to do the check.
+    needed to do the check: a fingerprint of path:mtime:size.
 
     index file format:
     sha1,mtime,size,path
@@ -40,70 +228,609 @@ def load_index(path):
 
     global index
 
+    if index_format.is_binary(path):
+        # the key is built from the undecoded records
+        keys = (
+            b"%s%s:%d:%d" % (prefix, name, mtime, size)
+            for _, mtime, size, prefix, name in index_format.read_records(path)
+        )
+    else:
+        keys = (
+            index_format.encode(":".join((row[3], row[1], row[2])))
+            for row in index_format.read_index(path)
+        )
+    index.update(keys)
+    index.freeze()
+
+
+def inode_key(stat):
+    return "{}:{}:{:d}:{:d}".format(
+        stat.st_dev, stat.st_ino, int(stat.st_mtime), stat.st_size
+    )
+
+
+def load_inodes(path):
+    """
+    Load the inode sidecar of an index. It maps the identity of a file
+    (st_dev, st_ino, mtime, size) to its SHA-1, so a file that is moved or
+    renamed within a file system is not hashed again under its new path.
+
+    inode file format:
+    dev,ino,mtime,size,sha1
+    """
+
+    global inodes
+
     with open(path, newline="") as csvfile:
         reader = csv.reader(csvfile)
         for row in reader:
-            v = ":".join((row[3], row[1], row[2]))
-            index.add(hashlib.sha1(v.encode("utf-8")).digest())
+            inodes.add(":".join(row[:4]), row[4])
+    inodes.freeze()
 
 
-def index_file(csv_file, de):
-    global counter
+def read_xattr(path, stat):
+    """
+    Return the SHA-1 stored in the xattr of a file, if the mtime and size
+    stored with it still match. Return None otherwise.
+    """
+    global no_xattr_devs
 
+    if stat.st_dev in no_xattr_devs:
+        return None
     try:
-        out = subprocess.check_output(["sha1sum", "-b", de.path])
-    except subprocess.CalledProcessError:
-        counter.files_err += 1
+        value = os.getxattr(path, XATTR).decode("ascii")
+    except OSError as e:
+        if e.errno == errno.ENOTSUP:
+            no_xattr_devs.add(stat.st_dev)
+        return None
+    hash_, sep, key = value.partition(":")
+    if not sep or key != "{:d}:{:d}".format(int(stat.st_mtime), stat.st_size):
+        return None
+    return hash_
+
+
+def write_xattr(path, stat, hash_):
+    """
+    Store the SHA-1 of a file in its xattr. Read-only file systems and file
+    systems without xattr support are remembered and skipped from then on.
+    """
+    global no_xattr_devs
+
+    if stat.st_dev in no_xattr_devs:
         return
-    hash, _ = out.split(maxsplit=1)
-    stat = de.stat()
-    csv_file.writerow((hash.decode("ascii"), int(stat.st_mtime), stat.st_size, de.path))
-    counter.files_hash += 1
-    counter.hash_size += stat.st_size
+    value = "{}:{:d}:{:d}".format(hash_, int(stat.st_mtime), stat.st_size)
+    try:
+        os.setxattr(path, XATTR, value.encode("ascii"))
+    except OSError as e:
+        if e.errno in (errno.ENOTSUP, errno.EROFS):
+            no_xattr_devs.add(stat.st_dev)
 
 
-def index_dir(args, csv_file, path):
-    global index
-    global counter
+def truncate_partial_row(path):
+    """Cut the last row of a file if it was not completely written."""
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        pos = max(size - 65536, 0)
+        f.seek(pos)
+        tail = f.read()
+        if not tail or tail.endswith(b"\n"):
+            return
+        f.truncate(pos + tail.rfind(b"\n") + 1)
 
-    counter.dirs_scan += 1
-    if args.v:
-        print("D {}".format(path))
+
+def sha1_file(path):
+    """Return the hex SHA-1 of a file, reading it in BLOCK_SIZE blocks."""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+class Hasher:
+    """
+    Hash files on a pool of worker threads and append the results to the
+    index. hashlib releases the GIL while hashing, so the workers run in
+    parallel. Rows are written by the caller's thread in submission order;
+    when more than `depth` files are in flight, submit() waits for the
+    oldest one and writes it. Every hashed file is also recorded in the
+    inode sidecar, and in its xattr if `xattr` is set. Every `checkpoint`
+    seconds both files are flushed and fsync'ed, so a killed run can be
+    resumed from them.
+
+    Files with more than one link are read only once per run: the first
+    path of an inode is hashed and the other links reuse its future while
+    it is in flight, then its raw SHA-1 once the row is written.
+    """
+
+    def __init__(self, index_file, inode_file, jobs, checkpoint=None, xattr=False):
+        self.files = (index_file, inode_file)
+        self.xattr = xattr
+        self.csv_file = csv.writer(index_file)
+        self.inode_file = csv.writer(inode_file)
+        self.checkpoint_interval = checkpoint
+        self.last_checkpoint = time.monotonic()
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+        self.pending = deque()
+        self.depth = jobs * 4
+        # (st_dev, st_ino) of the files with links -> future, or raw SHA-1
+        # once written
+        self.links = {}
+        self.start = None
+
+    def is_linked(self, stat):
+        """Return True if another link of this file is already scheduled."""
+        return stat.st_nlink > 1 and (stat.st_dev, stat.st_ino) in self.links
+
+    def queued(self):
+        """Return the number of files waiting to be written."""
+        return len(self.pending)
+
+    def submit(self, path, stat, hash_=None):
+        """
+        Schedule a file for hashing. If hash_ is given, the file is not read
+        and its row is written with that hash.
+        """
+        if self.start is None:
+            self.start = time.monotonic()
+        hashed = False
+        if hash_ is not None:
+            future = Future()
+            future.set_result(hash_)
+        elif self.is_linked(stat):
+            future = self.links[(stat.st_dev, stat.st_ino)]
+            if isinstance(future, bytes):
+                hash_ = future.hex()
+                future = Future()
+                future.set_result(hash_)
+        else:
+            future = self.pool.submit(sha1_file, path)
+            hashed = True
+            if stat.st_nlink > 1:
+                self.links[(stat.st_dev, stat.st_ino)] = future
+        self.pending.append((path, stat, future, hashed))
+        while len(self.pending) > self.depth:
+            self._write_one()
+
+    def _write_one(self):
+        global counter
+
+        path, stat, future, hashed = self.pending.popleft()
+        try:
+            hash_ = future.result()
+        except OSError as e:
+            print(e, file=sys.stderr)
+            counter.files_err += 1
+            if hashed:
+                counter.queued_size -= stat.st_size
+            return
+        mtime = int(stat.st_mtime)
+        self.csv_file.writerow((hash_, mtime, stat.st_size, path))
+        if not hashed:
+            return
+        if stat.st_nlink > 1:
+            # a future holds far more memory than the digest
+            self.links[(stat.st_dev, stat.st_ino)] = bytes.fromhex(hash_)
+        self.inode_file.writerow(
+            (stat.st_dev, stat.st_ino, mtime, stat.st_size, hash_)
+        )
+        if self.xattr:
+            write_xattr(path, stat, hash_)
+        counter.files_hash += 1
+        counter.hash_size += stat.st_size
+        if (
+            self.checkpoint_interval
+            and time.monotonic() - self.last_checkpoint >= self.checkpoint_interval
+        ):
+            self.checkpoint()
+
+    def checkpoint(self):
+        for f in self.files:
+            f.flush()
+            os.fsync(f.fileno())
+        self.last_checkpoint = time.monotonic()
+
+    def close(self):
+        global counter
+
+        while self.pending:
+            self._write_one()
+        self.pool.shutdown()
+        if self.start is not None:
+            counter.hash_time = time.monotonic() - self.start
+
+
+def physical_offset(path):
+    """
+    Return the physical offset of the first extent of a file, using the
+    FIEMAP ioctl. Return None for empty files and where FIEMAP is not
+    supported.
+    """
+    buf = bytearray(FIEMAP.pack(0, 2**64 - 1, 0, 0, 1, 0))
+    buf += bytes(FIEMAP_EXTENT.size)
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    if FIEMAP.unpack_from(buf)[3] == 0:
+        return None
+    return FIEMAP_EXTENT.unpack_from(buf, FIEMAP.size)[1]
+
+
+class Scheduler:
+    """
+    Put the files for a Hasher in physical order. Files are collected in
+    batches of up to `batch` entries, and each batch is sorted before it is
+    handed to the hasher, so a spinning disk reads it with short forward
+    seeks instead of in scandir order. With order="inode" the sort key is
+    the inode number. With order="extent" it is the physical offset of the
+    first extent, or the inode number where FIEMAP does not work.
+
+    The distance between the keys of consecutive files, in bytes or in
+    inode numbers, is summed in scan order and in sorted order, to show how
+    much seeking was saved.
+    """
+
+    def __init__(self, hasher, order, batch):
+        self.hasher = hasher
+        self.order = order
+        self.batch_size = batch
+        self.batch = []
+        self.batch_links = set()
+
+    def is_linked(self, stat):
+        return self.hasher.is_linked(stat) or (
+            stat.st_nlink > 1 and (stat.st_dev, stat.st_ino) in self.batch_links
+        )
+
+    def queued(self):
+        return len(self.batch) + self.hasher.queued()
+
+    def submit(self, path, stat, hash_=None):
+        if stat.st_nlink > 1:
+            self.batch_links.add((stat.st_dev, stat.st_ino))
+        self.batch.append((path, stat, hash_))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def _key(self, path, stat):
+        if self.order == "extent":
+            offset = physical_offset(path)
+            if offset is not None:
+                return (stat.st_dev, offset)
+        return (stat.st_dev, stat.st_ino)
+
+    def _seek_distance(self, keys):
+        distance = 0
+        for prev, key in zip(keys, keys[1:]):
+            if prev[0] == key[0]:
+                distance += abs(key[1] - prev[1])
+        return distance
+
+    def flush(self):
+        global counter
+
+        batch = self.batch
+        self.batch = []
+        self.batch_links = set()
+        # files that are not read go first, the rest in physical order
+        keys = [
+            (0, 0) if hash_ is not None else self._key(path, stat)
+            for path, stat, hash_ in batch
+        ]
+        read = [keys[i] for i, item in enumerate(batch) if item[2] is None]
+        counter.seek_scan += self._seek_distance(read)
+        counter.seek_sorted += self._seek_distance(sorted(read))
+        for i in sorted(range(len(batch)), key=keys.__getitem__):
+            self.hasher.submit(*batch[i])
+
+    def close(self):
+        self.flush()
+        self.hasher.close()
+
+
+class Rules:
+    """
+    Compiled --exclude and --include patterns in fnmatch syntax. Like in
+    rsync, a pattern that contains a "/" is matched against the whole path,
+    other patterns against the name only, and a pattern that ends with "/"
+    matches only directories. An entry that matches an include pattern is
+    never excluded. Excluded directories are not scanned at all.
+    """
+
+    def __init__(self, exclude, include):
+        self.exclude = self._compile(exclude or [])
+        self.include = self._compile(include or [])
+
+    @staticmethod
+    def _compile(patterns):
+        """
+        Return the regexes for (name, path) of any entry and for (name,
+        path) of directories only.
+        """
+        groups = ([], [], [], [])
+        for pattern in patterns:
+            group = 0
+            if pattern.endswith("/"):
+                pattern = pattern.rstrip("/")
+                group += 2
+            if "/" in pattern:
+                group += 1
+            groups[group].append(fnmatch.translate(pattern))
+        return [re.compile("|".join(g)) if g else None for g in groups]
+
+    @staticmethod
+    def _match(regexes, name, path, is_dir):
+        if not is_dir:
+            regexes = regexes[:2]
+        for rx, value in zip(regexes, (name, path, name, path)):
+            if rx is not None and rx.match(value):
+                return True
+        return False
+
+    def excluded(self, name, path, is_dir):
+        if not self._match(self.exclude, name, path, is_dir):
+            return False
+        return not self._match(self.include, name, path, is_dir)
+
+
+def scan_dir(path, rules=None, dev=None):
+    """
+    List a directory. Return the sub directories as (path, stat) pairs,
+    (DirEntry, stat) pairs for its regular files and the number of pruned
+    directories, files and file bytes. Entries excluded by rules are
+    pruned, and so are sub directories on another device than dev. The
+    stat of a directory is only taken when dev is set. Runs on the walker
+    threads, so it must not touch the global state.
+    """
     sub_dirs = []
     files = []
-    try:
-        with os.scandir(path) as dir:
-            for de in dir:
-                if de.is_dir():
-                    sub_dirs.append(de.path)
+    pruned = [0, 0, 0]
+    with os.scandir(path) as dir:
+        for de in dir:
+            if de.is_dir():
+                if rules and rules.excluded(de.name, de.path, True):
+                    pruned[0] += 1
                     continue
-                if not de.is_file():
-                    continue
-                # add file for hasing only if this verion of the file is
-                # not in the index
-                counter.files_scan += 1
-                f_stat = de.stat()
-                mtime = int(f_stat.st_mtime)
-                size = int(f_stat.st_size)
-                v = "{}:{:d}:{:d}".format(de.path, mtime, size)
-                hv = hashlib.sha1(v.encode("utf-8")).digest()
-                if hv in index:
-                    if args.v:
-                        print("- {} {} {}".format(de.path, mtime, size))
-                else:
-                    if args.v:
-                        print("+ {} {} {}".format(de.path, mtime, size))
-                    files.append(de)
-    except PermissionError as e:
-        print(e, file=sys.stderr)
-        counter.dirs_err += 1
-        return
-    for de in files:
+                d_stat = None
+                if dev is not None:
+                    d_stat = de.stat()
+                    if d_stat.st_dev != dev:
+                        pruned[0] += 1
+                        continue
+                sub_dirs.append((de.path, d_stat))
+                continue
+            if not de.is_file():
+                continue
+            f_stat = de.stat()
+            if rules and rules.excluded(de.name, de.path, False):
+                pruned[1] += 1
+                pruned[2] += f_stat.st_size
+                continue
+            files.append((de, f_stat))
+    return sub_dirs, files, pruned
+
+
+class Walker:
+    """
+    Schedule scan_dir() calls. With a single walker a directory is scanned
+    when its result is requested. With more walkers, every directory is
+    put on the work queue of a thread pool as soon as it is found, so
+    several scandir/stat round trips are in flight at once. This pays off
+    on NFS and FUSE mounts. index_dir() still consumes the results in
+    depth-first order, so the output is the same in both modes.
+    """
+
+    def __init__(self, walkers, rules=None):
+        self.rules = rules
+        self.pool = None
+        if walkers > 1:
+            self.pool = ThreadPoolExecutor(max_workers=walkers)
+
+    def submit(self, path, dev=None):
+        """Return a callable that returns the result of scan_dir()."""
+        if self.pool is None:
+            return functools.partial(scan_dir, path, self.rules, dev)
+        return self.pool.submit(scan_dir, path, self.rules, dev).result
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+def index_dir(args, hasher, walker, top):
+    global index
+    global inodes
+    global counter
+
+    # With --one-file-system, stay on the device of top and scan every
+    # directory once, even if it is bind mounted under another path.
+    dev = None
+    if args.one_file_system:
+        top_stat = os.stat(top)
+        dev = top_stat.st_dev
+        visited = {(top_stat.st_dev, top_stat.st_ino)}
+
+    stack = [(top, walker.submit(top, dev))]
+    while stack:
+        counter.dirs_pending = len(stack)
+        path, scan = stack.pop()
+        counter.dirs_scan += 1
         if args.v:
-            print("F {}".format(de.path))
-        index_file(csv_file, de)
-    for path in sub_dirs:
-        index_dir(args, csv_file, path)
+            print("D {}".format(path))
+        try:
+            sub_dirs, entries, pruned = scan()
+        except PermissionError as e:
+            print(e, file=sys.stderr)
+            counter.dirs_err += 1
+            continue
+        counter.dirs_pruned += pruned[0]
+        counter.files_pruned += pruned[1]
+        counter.pruned_size += pruned[2]
+        if dev is not None:
+            unique = []
+            for sub_dir in sub_dirs:
+                d_stat = sub_dir[1]
+                if (d_stat.st_dev, d_stat.st_ino) in visited:
+                    counter.dirs_pruned += 1
+                    continue
+                visited.add((d_stat.st_dev, d_stat.st_ino))
+                unique.append(sub_dir)
+            sub_dirs = unique
+        files = []
+        for de, f_stat in entries:
+            # add file for hasing only if this verion of the file is
+            # not in the index
+            counter.files_scan += 1
+            mtime = int(f_stat.st_mtime)
+            size = int(f_stat.st_size)
+            if "{}:{:d}:{:d}".format(de.path, mtime, size) in index:
+                if args.v:
+                    print("- {} {} {}".format(de.path, mtime, size))
+            else:
+                if args.v:
+                    print("+ {} {} {}".format(de.path, mtime, size))
+                files.append((de, f_stat))
+        for de, f_stat in files:
+            hash_ = inodes.get(inode_key(f_stat))
+            if hash_ is not None:
+                if args.v:
+                    print("M {}".format(de.path))
+                counter.files_moved += 1
+                counter.moved_size += f_stat.st_size
+            elif hasher.is_linked(f_stat):
+                if args.v:
+                    print("L {}".format(de.path))
+                counter.files_linked += 1
+                counter.linked_size += f_stat.st_size
+            elif args.xattr and (hash_ := read_xattr(de.path, f_stat)):
+                if args.v:
+                    print("X {}".format(de.path))
+                counter.files_xattr += 1
+                counter.xattr_size += f_stat.st_size
+            else:
+                if args.v:
+                    print("F {}".format(de.path))
+                counter.queued_size += f_stat.st_size
+            hasher.submit(de.path, f_stat, hash_)
+        # submit in order, so that the next directory popped is the first
+        # one on the work queue, and push reversed for depth-first order
+        scans = [(p, walker.submit(p, dev)) for p, _ in sub_dirs]
+        stack.extend(reversed(scans))
+    counter.dirs_pending = 0
+
+
+def write_shards(index_path, shards):
+    """
+    Split an index into `shards` CSV files, each with one range of hashes
+    and sorted by hash and path, for merge_index.py and the --sorted mode
+    of copy_files.py and reconstruct.py. Identical rows are written once.
+    """
+    names = [
+        "{}.shard-{:03d}-of-{:03d}".format(index_path, i, shards)
+        for i in range(shards)
+    ]
+    files = [open(name, "w", newline="") for name in names]
+    writers = [csv.writer(f) for f in files]
+    last = None
+    try:
+        rows = index_sort.sort_rows(
+            index_format.read_index(index_path), index_sort.by_hash_path
+        )
+        for row in rows:
+            if row == last:
+                continue
+            last = row
+            writers[int(row[0][:8], 16) * shards >> 32].writerow(row)
+    finally:
+        for f in files:
+            f.close()
+
+
+class Progress(threading.Thread):
+    """
+    Report the progress of the run every `interval` seconds on stderr,
+    as a status line or as one JSON object per line. The counters are
+    read without locking, which is good enough for a progress report.
+    The ETA is for the bytes already queued for hashing, so it grows
+    while the scan is still finding new files.
+    """
+
+    def __init__(self, hasher, interval, json_lines=False):
+        super().__init__(daemon=True)
+        self.hasher = hasher
+        self.interval = interval
+        self.json_lines = json_lines
+        self.stopped = threading.Event()
+
+    def run(self):
+        last = (time.monotonic(), counter.files_hash, counter.hash_size)
+        while not self.stopped.wait(self.interval):
+            now = (time.monotonic(), counter.files_hash, counter.hash_size)
+            self.report(now, last)
+            last = now
+
+    def report(self, now, last):
+        seconds = now[0] - last[0]
+        bytes_per_second = (now[2] - last[2]) / seconds
+        remaining = max(counter.queued_size - counter.hash_size, 0)
+        eta = remaining / bytes_per_second if bytes_per_second else None
+        stats = {
+            "files_scan": counter.files_scan,
+            "files_hash": counter.files_hash,
+            "files_per_s": (now[1] - last[1]) / seconds,
+            "mb_per_s": bytes_per_second / 1024**2,
+            "queue": self.hasher.queued(),
+            "dirs_pending": counter.dirs_pending,
+            "remaining_mb": remaining / 1024**2,
+            "eta_s": eta,
+        }
+        if self.json_lines:
+            print(json.dumps(stats), file=sys.stderr, flush=True)
+            return
+        stats["eta"] = "-" if eta is None else timedelta(seconds=int(eta))
+        print(
+            "\r{files_scan} scanned {files_hash} hashed {files_per_s:.0f} files/s "
+            "{mb_per_s:.1f} MB/s queue {queue} dirs {dirs_pending} "
+            "left {remaining_mb:.0f} MB ETA {eta}\033[K".format(**stats),
+            end="",
+            file=sys.stderr,
+            flush=True,
+        )
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        if not self.json_lines:
+            print(file=sys.stderr)
+
+
+def write_stats(path, args, started):
+    """Write the counters and phase timings of the run as JSON."""
+    stats = {
+        "started": started,
+        "dirs": args.dirs,
+        "index": args.index,
+        "index_length": len(index),
+        "counters": {
+            name: getattr(counter, name)
+            for name in vars(Counter)
+            if not name.startswith("_")
+        },
+        "phases": phases,
+    }
+    with open(path, "w") as f:
+        json.dump(stats, f, indent=2)
+        f.write("\n")
 
 
 def main():
@@ -116,8 +843,99 @@ def main():
         "-i",
         "--index",
         default="file_index",
-        help="Index file to be created or updated. A backup file is "
-        "created. Default to file_index",
+        help="Index file to be created or updated, CSV or binary. It keeps "
+        "its format. A backup file is created. Default to file_index",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of files hashed in parallel. Default to the number of CPUs",
+    )
+    parser.add_argument(
+        "-w",
+        "--walkers",
+        type=int,
+        default=1,
+        help="Number of directories scanned in parallel. Values above 1 help "
+        "on network and FUSE file systems. Default to 1",
+    )
+    parser.add_argument(
+        "--io-order",
+        choices=("inode", "extent"),
+        help="Hash files in batches sorted by inode number or by the physical "
+        "offset of their data (FIEMAP). Reduces seeks on spinning disks",
+    )
+    parser.add_argument(
+        "--io-batch",
+        type=int,
+        default=10000,
+        help="Number of files sorted together with --io-order. Default to 10000",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=int,
+        default=60,
+        help="Flush and fsync the temporary index every N seconds. "
+        "Default to 60",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the newest interrupted run from its temporary index "
+        "instead of starting from the index",
+    )
+    parser.add_argument(
+        "--xattr",
+        action="store_true",
+        help="Store the hash of every hashed file in its {} extended "
+        "attribute and trust it on later runs while mtime and size match, "
+        "even without an index".format(XATTR),
+    )
+    parser.add_argument(
+        "-e",
+        "--exclude",
+        action="append",
+        help="Do not index files and directories matching this pattern. A "
+        "pattern with a / is matched against the path, otherwise against the "
+        "name. A trailing / matches only directories. Can be repeated",
+    )
+    parser.add_argument(
+        "--include",
+        action="append",
+        help="Index files and directories matching this pattern even if they "
+        "match an --exclude pattern. Can be repeated",
+    )
+    parser.add_argument(
+        "-x",
+        "--one-file-system",
+        action="store_true",
+        help="Do not cross file system boundaries and do not scan the same "
+        "directory twice through bind mounts",
+    )
+    parser.add_argument(
+        "--progress",
+        type=float,
+        metavar="SECONDS",
+        help="Show a progress line on stderr every SECONDS",
+    )
+    parser.add_argument(
+        "--progress-json",
+        action="store_true",
+        help="Print the progress as JSON lines instead of a status line",
+    )
+    parser.add_argument(
+        "--stats-json",
+        metavar="FILE",
+        help="Write the final counters and the time of each phase (load, "
+        "scan, hash, rename, shards) to FILE as JSON",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        help="After the run, also write the index as N files sorted by hash, "
+        "<index>.shard-<i>-of-<N>",
     )
     parser.add_argument("-v", action="count", default=0, help="verbose")
 
@@ -131,21 +949,87 @@ def main():
     backup_filename = "{}.bak-{}".format(
         args.index, time.strftime("%Y%m%d-%H%M%S", localtime)
     )
+    if args.resume:
+        tmp_files = sorted(glob.glob(glob.escape(args.index) + ".tmp-*"))
+        if tmp_files:
+            index_filename = tmp_files[-1]
+            print("Resuming {}".format(index_filename))
+    inodes_name = "{}.inodes".format(args.index)
+    inodes_filename = "{}.tmp-{}".format(
+        inodes_name, index_filename.rsplit(".tmp-", 1)[1]
+    )
+    # the rows are appended as CSV, a binary index is written back in
+    # binary at the end
+    binary = os.path.isfile(args.index) and index_format.is_binary(args.index)
+    binary_filename = "{}.bin-{}".format(
+        args.index, index_filename.rsplit(".tmp-", 1)[1]
+    )
 
-    if os.path.isfile(args.index):
-        shutil.copyfile(args.index, index_filename)
-        load_index(index_filename)
+    # A temporary file left by an interrupted run already contains the rows
+    # of the index it was copied from.
+    with phase("load"):
+        if os.path.isfile(index_filename):
+            truncate_partial_row(index_filename)
+        elif os.path.isfile(args.index):
+            if binary:
+                with open(index_filename, "w", newline="") as f:
+                    csv.writer(f).writerows(index_format.read_index(args.index))
+            else:
+                shutil.copyfile(args.index, index_filename)
+        if os.path.isfile(index_filename):
+            load_index(index_filename)
+        if os.path.isfile(inodes_filename):
+            truncate_partial_row(inodes_filename)
+        elif os.path.isfile(inodes_name):
+            shutil.copyfile(inodes_name, inodes_filename)
+        if os.path.isfile(inodes_filename):
+            load_inodes(inodes_filename)
 
-    with open(index_filename, "a") as index_file:
-        csv_file = csv.writer(index_file)
-        for path in args.dirs:
-            index_dir(args, csv_file, path)
+    with open(index_filename, "a") as index_file, open(
+        inodes_filename, "a"
+    ) as inode_file:
+        hasher = Hasher(
+            index_file, inode_file, args.jobs, args.checkpoint, args.xattr
+        )
+        if args.io_order:
+            hasher = Scheduler(hasher, args.io_order, args.io_batch)
+        progress = None
+        if args.progress:
+            progress = Progress(hasher, args.progress, args.progress_json)
+            progress.start()
+        walker = Walker(args.walkers, Rules(args.exclude, args.include))
+        # hashing overlaps with the scan, the hash phase is the time
+        # spent waiting for the files still queued when the scan ends
+        with phase("scan"):
+            for path in args.dirs:
+                index_dir(args, hasher, walker, path)
+            walker.close()
+        with phase("hash"):
+            hasher.close()
+        if progress is not None:
+            progress.stop()
 
-    try:
-        os.rename(args.index, backup_filename)
-    except FileNotFoundError:
-        pass
-    os.rename(index_filename, args.index)
+    with phase("rename"):
+        if binary:
+            with index_format.BinaryWriter(binary_filename) as writer:
+                writer.writerows(index_format.read_index(index_filename))
+        try:
+            os.rename(args.index, backup_filename)
+        except FileNotFoundError:
+            pass
+        if binary:
+            os.rename(binary_filename, args.index)
+            os.remove(index_filename)
+        else:
+            os.rename(index_filename, args.index)
+        os.rename(inodes_filename, inodes_name)
+
+    if args.shards:
+        with phase("shards"):
+            write_shards(args.index, args.shards)
+
+    if args.stats_json:
+        write_stats(args.stats_json, args, now)
 
     if args.v:
         print("""
@@ -154,25 +1038,56 @@ Flags:
 +  File is not found in the index and scheduled for hashing
 D  Directory is scaned.
 F  File is hashed
+M  File is moved or renamed, the hash of its inode is reused
+L  File is a hard link of a file hashed in this run, its hash is reused
+X  File hash is taken from its extended attribute
 """)
     print(
         """Counters:
     Input index length:  {:12d}
     Scanned dirs:        {:12d}
     Scanned files:       {:12d}
+    Pruned dirs:         {:12d}
+    Pruned files:        {:12d}
+    Pruned files MB:     {:12.0f}
     Hashed files:        {:12d}
     Hashed MB:           {:12.0f}
+    Hashed MB/s:         {:12.1f}
+    Moved files:         {:12d}
+    Moved MB (not read): {:12.0f}
+    Linked files:        {:12d}
+    Linked MB (not read):{:12.0f}
+    Xattr files:         {:12d}
+    Xattr MB (not read): {:12.0f}
     Error reading dirs:  {:12d}
     Error reading files: {:12d}""".format(
             len(index),
             counter.dirs_scan,
             counter.files_scan,
+            counter.dirs_pruned,
+            counter.files_pruned,
+            counter.pruned_size / 1024**2,
             counter.files_hash,
             counter.hash_size / 1024**2,
+            counter.hash_size / 1024**2 / max(counter.hash_time, 1e-9),
+            counter.files_moved,
+            counter.moved_size / 1024**2,
+            counter.files_linked,
+            counter.linked_size / 1024**2,
+            counter.files_xattr,
+            counter.xattr_size / 1024**2,
             counter.dirs_err,
             counter.files_err,
         )
     )
+    if args.io_order and counter.seek_sorted:
+        # bytes on disk for extent, inode numbers for inode
+        unit = "Seek" if args.io_order == "extent" else "Inode"
+        print(
+            "    {:21}{:12.1f}x".format(
+                unit + " distance cut:", counter.seek_scan / counter.seek_sorted
+            )
+        )
 
 
 if __name__ == "__main__":
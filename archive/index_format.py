@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Reader and writer of index files in CSV and in binary format.
+
+The CSV format written by file_index.py has one row per file:
+
+    sha1,mtime,size,path
+
+The binary format holds the same rows in fixed width records, so a tool
+can mmap it and look at any row without parsing the ones before it:
+
+    header   HEADER, see below
+    records  RECORD per row: raw sha1, mtime, size, prefix id, name
+             offset and name length
+    prefixes PREFIX per distinct directory prefix: offset and length
+    strings  UTF-8 prefixes and names, referenced by offset and length
+
+The prefix of a path is everything up to and including its last "/", so
+path == prefix + name for every path and the conversion is lossless in
+both directions. Every prefix is stored once.
+
+    index_format.py to-binary INDEX OUT
+    index_format.py to-csv INDEX OUT
+"""
+
+import argparse
+import csv
+import mmap
+import shutil
+import struct
+import tempfile
+
+MAGIC = b"FIDXBIN1"
+# magic, flags, rows, prefixes, records offset, prefixes offset,
+# strings offset, strings size
+HEADER = struct.Struct("<8sQQQQQQQ")
+RECORD = struct.Struct("<20sqQIQI")
+PREFIX = struct.Struct("<QI")
+
+# rows are sorted by sha1 and path
+FLAG_SORTED = 1
+
+
+def encode(s):
+    return s.encode("utf-8", "surrogateescape")
+
+
+def decode(b):
+    return b.decode("utf-8", "surrogateescape")
+
+
+def is_binary(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def is_sorted(path):
+    """Return True for a binary index flagged as sorted by sha1 and path."""
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size or not header.startswith(MAGIC):
+        return False
+    return bool(HEADER.unpack(header)[1] & FLAG_SORTED)
+
+
+class BinaryWriter:
+    """
+    Write a binary index. writerow() takes the same rows as csv.writer, with
+    the integers as int or str. Records are written as they come, strings
+    are spooled to a temporary file and appended on close().
+    """
+
+    def __init__(self, path, sorted_by_hash=False):
+        self.file = open(path, "wb")
+        self.flags = FLAG_SORTED if sorted_by_hash else 0
+        self.strings = tempfile.TemporaryFile()
+        self.strings_size = 0
+        self.prefix_ids = {}
+        self.prefixes = bytearray()
+        self.rows = 0
+        self.file.write(bytes(HEADER.size))
+
+    def _add_string(self, s):
+        b = encode(s)
+        offset = self.strings_size
+        self.strings.write(b)
+        self.strings_size += len(b)
+        return offset, len(b)
+
+    def writerow(self, row):
+        hash_, mtime, size, path = row
+        digest = bytes.fromhex(hash_)
+        if len(digest) != 20:
+            raise ValueError("Invalid SHA-1 {!r} for {}".format(hash_, path))
+        prefix, sep, name = path.rpartition("/")
+        prefix += sep
+        prefix_id = self.prefix_ids.get(prefix)
+        if prefix_id is None:
+            prefix_id = len(self.prefix_ids)
+            self.prefix_ids[prefix] = prefix_id
+            self.prefixes += PREFIX.pack(*self._add_string(prefix))
+        name_offset, name_size = self._add_string(name)
+        self.file.write(
+            RECORD.pack(
+                digest,
+                int(mtime),
+                int(size),
+                prefix_id,
+                name_offset,
+                name_size,
+            )
+        )
+        self.rows += 1
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def close(self):
+        records_offset = HEADER.size
+        prefixes_offset = records_offset + self.rows * RECORD.size
+        strings_offset = prefixes_offset + len(self.prefixes)
+        self.file.write(self.prefixes)
+        self.strings.seek(0)
+        shutil.copyfileobj(self.strings, self.file)
+        self.strings.close()
+        self.file.seek(0)
+        self.file.write(
+            HEADER.pack(
+                MAGIC,
+                self.flags,
+                self.rows,
+                len(self.prefix_ids),
+                records_offset,
+                prefixes_offset,
+                strings_offset,
+                self.strings_size,
+            )
+        )
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BinaryIndex:
+    """
+    Memory mapped binary index. Rows are decoded only when asked for, and
+    hash() returns the raw digest of a row without decoding anything else.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic,
+            self.flags,
+            self.rows,
+            n_prefixes,
+            self.records_offset,
+            prefixes_offset,
+            self.strings_offset,
+            strings_size,
+        ) = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError("{} is not a binary index".format(path))
+        self.prefix_table = [
+            PREFIX.unpack_from(self.mm, prefixes_offset + i * PREFIX.size)
+            for i in range(n_prefixes)
+        ]
+        self.prefix_cache = {}
+
+    @property
+    def sorted_by_hash(self):
+        return bool(self.flags & FLAG_SORTED)
+
+    def __len__(self):
+        return self.rows
+
+    def _string(self, offset, size):
+        start = self.strings_offset + offset
+        return decode(self.mm[start : start + size])
+
+    def _prefix(self, prefix_id):
+        prefix = self.prefix_cache.get(prefix_id)
+        if prefix is None:
+            prefix = self._string(*self.prefix_table[prefix_id])
+            self.prefix_cache[prefix_id] = prefix
+        return prefix
+
+    def hash(self, i):
+        """Return the raw SHA-1 of row i."""
+        start = self.records_offset + i * RECORD.size
+        return self.mm[start : start + 20]
+
+    def _row(self, record):
+        hash_, mtime, size, prefix_id, name_offset, name_size = record
+        path = self._prefix(prefix_id) + self._string(name_offset, name_size)
+        return [hash_.hex(), str(mtime), str(size), path]
+
+    def row(self, i):
+        """Return row i the way csv.reader returns it."""
+        record = RECORD.unpack_from(self.mm, self.records_offset + i * RECORD.size)
+        return self._row(record)
+
+    def __iter__(self):
+        mm = self.mm
+        prefix = self._prefix
+        strings_offset = self.strings_offset
+        end = self.records_offset + self.rows * RECORD.size
+        with memoryview(mm) as view:
+            records = view[self.records_offset : end]
+            try:
+                for hash_, mtime, size, prefix_id, offset, name_size in (
+                    RECORD.iter_unpack(records)
+                ):
+                    start = strings_offset + offset
+                    name = decode(mm[start : start + name_size])
+                    path = prefix(prefix_id) + name
+                    yield [hash_.hex(), str(mtime), str(size), path]
+            finally:
+                records.release()
+
+    def records(self):
+        """
+        Yield the rows as (raw sha1, mtime, size, prefix, name), with int
+        mtime and size and the prefix and name as bytes, so that nothing is
+        decoded. path == decode(prefix + name).
+        """
+        mm = self.mm
+        strings_offset = self.strings_offset
+        prefixes = [
+            mm[strings_offset + offset : strings_offset + offset + size]
+            for offset, size in self.prefix_table
+        ]
+        end = self.records_offset + self.rows * RECORD.size
+        with memoryview(mm) as view:
+            records = view[self.records_offset : end]
+            try:
+                for hash_, mtime, size, prefix_id, offset, name_size in (
+                    RECORD.iter_unpack(records)
+                ):
+                    start = strings_offset + offset
+                    yield (
+                        hash_,
+                        mtime,
+                        size,
+                        prefixes[prefix_id],
+                        mm[start : start + name_size],
+                    )
+            finally:
+                records.release()
+
+    def close(self):
+        self.mm.close()
+
+
+def read_index(path):
+    """
+    Yield the rows of an index file in CSV or binary format, the way
+    csv.reader returns them: [sha1, mtime, size, path], all str.
+    """
+    if is_binary(path):
+        index = BinaryIndex(path)
+        try:
+            yield from index
+        finally:
+            index.close()
+        return
+    with open(path, newline="") as csvfile:
+        yield from csv.reader(csvfile)
+
+
+def read_records(path):
+    """
+    Yield the rows of an index file in CSV or binary format as
+    (raw sha1, mtime, size, prefix, name), see BinaryIndex.records(). A
+    binary index is read without building any str.
+    """
+    if is_binary(path):
+        index = BinaryIndex(path)
+        try:
+            yield from index.records()
+        finally:
+            index.close()
+        return
+    with open(path, newline="") as csvfile:
+        # the whole path is in the name, splitting it would only cost time
+        for hash_, mtime, size, file_path in csv.reader(csvfile):
+            yield bytes.fromhex(hash_), int(mtime), int(size), b"", encode(file_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert index files between CSV and binary format"
+    )
+    parser.add_argument("command", choices=("to-binary", "to-csv"))
+    parser.add_argument("index", help="Input index file, CSV or binary")
+    parser.add_argument("out", help="Output index file")
+    args = parser.parse_args()
+
+    if args.command == "to-binary":
+        with BinaryWriter(args.out) as writer:
+            writer.writerows(read_index(args.index))
+    else:
+        with open(args.out, "w", newline="") as out_file:
+            csv.writer(out_file).writerows(read_index(args.index))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+External merge sort of index rows.
+
+Indexes can be much larger than RAM, so the rows are sorted in runs of
+RUN_SIZE rows that are spilled to temporary CSV files and merged back with
+heapq.merge. Both the sort of a run and the merge are stable, so rows with
+equal keys come out in input order.
+
+Indexes that are already sorted by hash (shards written by file_index.py
+and catalogs written by merge_index.py) can be streamed one hash at a time
+with hash_groups(), without loading them.
+"""
+
+import csv
+import heapq
+import itertools
+import tempfile
+
+import index_format
+
+RUN_SIZE = 1_000_000
+# maximum number of runs merged at once, to stay below the fd limit
+MERGE_WIDTH = 256
+
+
+def by_path(row):
+    return row[3]
+
+
+def by_hash(row):
+    return row[0]
+
+
+def by_hash_path(row):
+    return row[0], row[3]
+
+
+def check_sorted(rows, key, name):
+    """Pass rows through and raise ValueError if they are not sorted by key."""
+    last = None
+    for row in rows:
+        k = key(row)
+        if last is not None and k < last:
+            raise ValueError("{} is not sorted: {} after {}".format(name, k, last))
+        last = k
+        yield row
+
+
+def join(left, right, key):
+    """
+    Merge two iterables of rows sorted by key. Yield (key, left rows, right
+    rows) for every key, with an empty list on the side that lacks it.
+    """
+    left = itertools.groupby(left, key=key)
+    right = itertools.groupby(right, key=key)
+    lk, lg = next(left, (None, None))
+    rk, rg = next(right, (None, None))
+    while lg is not None or rg is not None:
+        if rg is None or lg is not None and lk < rk:
+            yield lk, list(lg), []
+            lk, lg = next(left, (None, None))
+        elif lg is None or rk < lk:
+            yield rk, [], list(rg)
+            rk, rg = next(right, (None, None))
+        else:
+            yield lk, list(lg), list(rg)
+            lk, lg = next(left, (None, None))
+            rk, rg = next(right, (None, None))
+
+
+def hash_groups(paths):
+    """
+    Merge index files sorted by hash and yield (hash, [(path, mtime, size),
+    ...]) for every hash, holding only one group in memory.
+    """
+    sources = [
+        check_sorted(index_format.read_index(path), by_hash, path) for path in paths
+    ]
+    rows = heapq.merge(*sources, key=by_hash)
+    for hash_, group in itertools.groupby(rows, key=by_hash):
+        yield hash_, [(path, mtime, size) for _, mtime, size, path in group]
+
+
+def _spill(rows, tmpdir):
+    f = tempfile.TemporaryFile("w+", newline="", dir=tmpdir)
+    csv.writer(f).writerows(rows)
+    f.seek(0)
+    return f
+
+
+def _merge(runs, key, tmpdir):
+    """Merge runs until there are at most MERGE_WIDTH left."""
+    while len(runs) > MERGE_WIDTH:
+        merged = []
+        for i in range(0, len(runs), MERGE_WIDTH):
+            group = runs[i : i + MERGE_WIDTH]
+            readers = [csv.reader(f) for f in group]
+            merged.append(_spill(heapq.merge(*readers, key=key), tmpdir))
+            for f in group:
+                f.close()
+        runs = merged
+    return runs
+
+
+def sort_rows(rows, key, run_size=RUN_SIZE, tmpdir=None):
+    """
+    Yield rows sorted by key with bounded memory. At most run_size rows are
+    held in memory at a time. Temporary files are created in tmpdir.
+    """
+    runs = []
+    try:
+        rows = iter(rows)
+        while True:
+            run = list(itertools.islice(rows, run_size))
+            if not run:
+                break
+            run.sort(key=key)
+            if not runs and len(run) < run_size:
+                # everything fits in one run
+                yield from run
+                return
+            runs.append(_spill(run, tmpdir))
+            del run
+        runs = _merge(runs, key, tmpdir)
+        yield from heapq.merge(*(csv.reader(f) for f in runs), key=key)
+    finally:
+        for f in runs:
+            f.close()
+
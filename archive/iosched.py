@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+I/O budget shared by the archive tools.
+
+copy_files.py, packs.py verify and object_format.py verify take the
+options of add_arguments():
+
+    --io-bandwidth RATE  bytes read per second, with a K, M or G suffix
+    --io-iops N          reads and opened files per second
+    --io-control FILE    file with the two limits, see below
+    --io-idle            idle I/O priority, the disks serve the tool only
+                         when nobody else uses them
+
+Both limits are token buckets holding one second of budget, shared by all
+the threads of a tool. A read larger than the bucket is allowed and the
+next ones wait until it is paid for, so the average rate holds whatever
+the buffer sizes.
+
+The control file holds one limit per line, 0 or no line for no limit:
+
+    bandwidth=20M
+    iops=200
+
+It is read again when it changes, which is checked every second, or at
+once on SIGHUP. Editing it changes the rate of a running copy or scrub,
+e.g. from a cron job at the start and the end of business hours.
+"""
+
+import ctypes
+import os
+import platform
+import signal
+import sys
+import threading
+import time
+
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+# number of the ioprio_set syscall, there is no libc wrapper
+SYS_IOPRIO_SET = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "riscv64": 30,
+    "armv7l": 314,
+    "ppc64le": 273,
+    "s390x": 282,
+}
+# seconds between checks of the control file
+CONTROL_CHECK = 1.0
+
+SUFFIXES = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(value):
+    """Parse a number of bytes with an optional K, M, G or T suffix."""
+    value = value.strip()
+    scale = SUFFIXES.get(value[-1:].upper(), 1)
+    if scale != 1:
+        value = value[:-1]
+    return int(float(value) * scale)
+
+
+def set_idle_priority():
+    """
+    Put the calling thread in the idle I/O class. Threads started after
+    inherit it, so call it before starting any. Return False if the
+    kernel or the platform does not allow it.
+    """
+    nr = SYS_IOPRIO_SET.get(platform.machine())
+    if nr is None:
+        return False
+    libc = ctypes.CDLL(None, use_errno=True)
+    ioprio = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+    return libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, ioprio) == 0
+
+
+class Bucket:
+    """Token bucket of rate tokens per second, 0 for no limit."""
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.tokens = min(self.tokens, rate)
+
+    def take(self, amount, now):
+        """Take amount tokens, return how long to wait until they are paid."""
+        if not self.rate:
+            return 0
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class Throttled:
+    """A file whose read() is paid from a Budget."""
+
+    def __init__(self, f, budget):
+        self.f = f
+        self.budget = budget
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.budget.acquire(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+class Budget:
+    """Bandwidth and IOPS limits shared by the threads of a tool."""
+
+    def __init__(self, bandwidth=0, iops=0, control=None):
+        self.lock = threading.Lock()
+        self.bandwidth = Bucket(bandwidth)
+        self.iops = Bucket(iops)
+        self.control = control
+        self.control_mtime = None
+        self.checked = 0
+        self.reload = False
+        if control:
+            self._load()
+            signal.signal(signal.SIGHUP, self._on_sighup)
+
+    @property
+    def limited(self):
+        return bool(self.control or self.bandwidth.rate or self.iops.rate)
+
+    def configure(self, bandwidth=0, iops=0):
+        with self.lock:
+            self.bandwidth.set_rate(bandwidth)
+            self.iops.set_rate(iops)
+
+    def _on_sighup(self, signum, frame):
+        # runs between two bytecodes of the main thread, which may hold
+        # the lock: only ask for a reload
+        self.reload = True
+
+    def _load(self):
+        try:
+            mtime = os.stat(self.control).st_mtime
+            if mtime == self.control_mtime and not self.reload:
+                return
+            limits = {"bandwidth": 0, "iops": 0}
+            with open(self.control) as f:
+                for line in f:
+                    line = line.split("#")[0].strip()
+                    if not line:
+                        continue
+                    name, _, value = line.partition("=")
+                    name = name.strip()
+                    if name not in limits:
+                        raise ValueError("unknown limit {!r}".format(name))
+                    limits[name] = parse_size(value)
+        except (OSError, ValueError) as e:
+            print(
+                "W: {}: {}, limits unchanged".format(self.control, e), file=sys.stderr
+            )
+            return
+        finally:
+            self.reload = False
+        self.control_mtime = mtime
+        self.configure(limits["bandwidth"], limits["iops"])
+
+    def acquire(self, nbytes=0, ops=1):
+        """Wait until nbytes and ops operations fit in the budget."""
+        if not self.limited:
+            return
+        now = time.monotonic()
+        if self.control and (self.reload or now - self.checked >= CONTROL_CHECK):
+            self.checked = now
+            self._load()
+        with self.lock:
+            wait = max(self.bandwidth.take(nbytes, now), self.iops.take(ops, now))
+        if wait:
+            time.sleep(wait)
+
+    def file(self, f):
+        """Return f with its reads paid from the budget, opening it is an op."""
+        if not self.limited:
+            return f
+        self.acquire()
+        return Throttled(f, self)
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--io-bandwidth",
+        type=parse_size,
+        default=0,
+        metavar="RATE",
+        help="Read at most RATE bytes per second, e.g. 50M. Default to no limit",
+    )
+    parser.add_argument(
+        "--io-iops",
+        type=int,
+        default=0,
+        metavar="N",
+        help="At most N reads and opened files per second. Default to no limit",
+    )
+    parser.add_argument(
+        "--io-control",
+        metavar="FILE",
+        help="File with the limits, bandwidth=RATE and iops=N lines, read "
+        "again when it changes or on SIGHUP. Overrides the options",
+    )
+    parser.add_argument(
+        "--io-idle", action="store_true", help="Use the idle I/O priority class"
+    )
+
+
+def from_args(args):
+    """Set the I/O priority and return the Budget of the parsed options."""
+    if args.io_idle and not set_idle_priority():
+        print("W: cannot set the idle I/O priority", file=sys.stderr)
+    return Budget(args.io_bandwidth, args.io_iops, args.io_control)
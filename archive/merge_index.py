@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Merge index files of several hosts into one catalog sorted by hash.
+
+Inputs that are already sorted by hash (with --sorted, or binary indexes
+flagged as sorted) are streamed as they are. All other inputs are sorted
+together with an external merge sort first. Then a k-way merge produces
+the catalog, keeping one row per (hash, path): the one with the newest
+mtime. copy_files.py and reconstruct.py read a catalog one hash at a time
+with their --sorted option.
+"""
+
+import argparse
+import csv
+import heapq
+import itertools
+import time
+
+import index_format
+import index_sort
+
+
+def merge(paths, presorted=False, run_size=index_sort.RUN_SIZE, tmpdir=None):
+    """Yield the deduplicated rows of all index files sorted by hash, path."""
+    sorted_sources = []
+    unsorted = []
+    for path in paths:
+        if presorted or index_format.is_sorted(path):
+            sorted_sources.append(
+                index_sort.check_sorted(
+                    index_format.read_index(path), index_sort.by_hash_path, path
+                )
+            )
+        else:
+            unsorted.append(path)
+    if unsorted:
+        rows = itertools.chain.from_iterable(map(index_format.read_index, unsorted))
+        sorted_sources.append(
+            index_sort.sort_rows(rows, index_sort.by_hash_path, run_size, tmpdir)
+        )
+    rows = heapq.merge(*sorted_sources, key=index_sort.by_hash_path)
+    for _, group in itertools.groupby(rows, key=index_sort.by_hash_path):
+        yield max(group, key=lambda row: int(row[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge index files into one catalog sorted by hash"
+    )
+    parser.add_argument("index", nargs="+", help="Index files, CSV or binary")
+    parser.add_argument("-o", "--out", required=True, help="Catalog file")
+    parser.add_argument(
+        "--binary", action="store_true", help="Write the catalog in binary format"
+    )
+    parser.add_argument(
+        "--sorted",
+        action="store_true",
+        help="All inputs are already sorted by hash and path, e.g. shards "
+        "written by file_index.py --shards or other catalogs",
+    )
+    parser.add_argument(
+        "--run-size",
+        type=int,
+        default=index_sort.RUN_SIZE,
+        help="Number of rows sorted in memory at a time. Default to {}".format(
+            index_sort.RUN_SIZE
+        ),
+    )
+    parser.add_argument("--tmpdir", help="Directory for the temporary sort files")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    rows_out = 0
+    if args.binary:
+        out_file = index_format.BinaryWriter(args.out, sorted_by_hash=True)
+        writer = out_file
+    else:
+        out_file = open(args.out, "w", newline="")
+        writer = csv.writer(out_file)
+    with out_file:
+        for row in merge(args.index, args.sorted, args.run_size, args.tmpdir):
+            writer.writerow(row)
+            rows_out += 1
+
+    print(
+        """Counters:
+    Input indexes:       {:12d}
+    Catalog rows:        {:12d}
+    Time (s):            {:12.1f}""".format(
+            len(args.index), rows_out, time.monotonic() - start
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,6 @@
 
 from __future__ import annotations
 
-import csv
 import errno
 import logging
 import os
@@ -11,12 +10,15 @@ import pathlib
 import stat
 import sys
 
-from argparse import ArgumentParser, FileType
+from argparse import ArgumentParser
 from dataclasses import dataclass, field
 
 import pyfuse3
 import trio
 
+import index_format
+import object_format
+import packs
 
 from pyfuse3 import FUSEError
 
@@ -55,39 +57,39 @@ class ArchiveFs(pyfuse3.Operations):
         self.last_inode = 0
         self.entries_by_inode = {}
         self.openfd = set()
+        # fh -> CompressedObject, ChunkedObject or packs.PackedObject
+        self.objects = {}
         self.paths = {}
+        self.packs = packs.Packs(base_path)
         self._load_index()
 
     def _load_index(self):
-        with self.index_file as f:
-            reader = csv.reader(f)
-
-            root = FileEntry()
-            root.is_dir = True
+        root = FileEntry()
+        root.is_dir = True
+        self.last_inode += 1
+        self.entries_by_inode[self.last_inode] = root
+        root.is_dir = True
+        root.path = "/"
+        self.paths["/"] = root
+
+        for row in index_format.read_index(self.index_file):
+            hash_, mtime, size, path = row[:]
+            entry = FileEntry()
+            pp = pathlib.PurePath(path)
             self.last_inode += 1
-            self.entries_by_inode[self.last_inode] = root
-            root.is_dir = True
-            root.path = "/"
-            self.paths["/"] = root
-
-            for row in reader:
-                hash_, mtime, size, path = row[:]
-                entry = FileEntry()
-                pp = pathlib.PurePath(path)
-                self.last_inode += 1
-                self.entries_by_inode[self.last_inode] = entry
-                entry.inode = self.last_inode
-                entry.path = path
-                entry.filename = pp.name
-                entry.dir_path = pp.parent.as_posix()
-                entry.parent = self._get_dir(entry.dir_path)
-                entry.hash_ = hash_
-
-                entry.mtime = int(mtime)
-                entry.size = int(size)
-
-                entry.parent.files.append(entry)
-                self.paths[path] = entry
+            self.entries_by_inode[self.last_inode] = entry
+            entry.inode = self.last_inode
+            entry.path = path
+            entry.filename = pp.name
+            entry.dir_path = pp.parent.as_posix()
+            entry.parent = self._get_dir(entry.dir_path)
+            entry.hash_ = hash_
+
+            entry.mtime = int(mtime)
+            entry.size = int(size)
+
+            entry.parent.files.append(entry)
+            self.paths[path] = entry
 
     def _get_dir(self, path: str) -> FileEntry:
         log.debug("_get_dir %s", path)
@@ -198,6 +200,13 @@ class ArchiveFs(pyfuse3.Operations):
         log.debug("Openinig %s", filename)
         try:
             fh = os.open(filename, flags)
+        except FileNotFoundError:
+            try:
+                obj = object_format.open_object(self.base_path, hash_, self.packs)
+            except OSError as exc:
+                raise FUSEError(exc.errno)
+            fh = obj.fd
+            self.objects[fh] = obj
         except OSError as exc:
             raise FUSEError(exc.errno)
         self.openfd.add(fh)
@@ -206,14 +215,21 @@ class ArchiveFs(pyfuse3.Operations):
     async def read(self, fh, off, size):
         log.debug("read fh=%d off=%d size=%d", fh, off, size)
         assert fh in self.openfd
+        if fh in self.objects:
+            return self.objects[fh].read(off, size)
         os.lseek(fh, off, os.SEEK_SET)
         return os.read(fh, size)
 
     async def release(self, fh):
         log.debug("release fh=%d", fh)
         assert fh in self.openfd
+        self.openfd.discard(fh)
+        obj = self.objects.pop(fh, None)
         try:
-            os.close(fh)
+            if obj:
+                obj.close()
+            else:
+                os.close(fh)
         except OSError as exc:
             raise FUSEError(exc.errno)
 
@@ -242,8 +258,7 @@ def parse_args(args):
 
     parser.add_argument(
         "index_file",
-        type=FileType("r", encoding="utf-8"),
-        help="Path to the index file",
+        help="Path to the index file, CSV or binary",
     )
     parser.add_argument(
         "base_path",
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compressed objects of an archive store.
+
+copy_files.py --compress stores an object as <store>/xx/yy/<sha1>.z
+instead of <sha1> when its first chunk compresses. The data is cut in
+fixed size chunks that are compressed independently, so a reader can
+decompress only the chunks it needs:
+
+    chunks   compressed chunks, or raw chunks that did not compress
+    table    chunks + 1 offsets of the chunks in the file, "<Q" each
+    trailer  TRAILER, see below
+
+A chunk is raw when its stored length is the length of its data, since
+a compressed chunk is kept only when it is smaller. The trailer is at
+the end, so an object is written in one sequential pass.
+
+copy_files.py --chunk-above cuts large files in content defined chunks,
+which are stored once as objects of their own, raw or compressed. The
+file becomes a manifest, <store>/xx/yy/<sha1>.m:
+
+    MANIFEST_MAGIC
+    MANIFEST_ENTRY per chunk: raw sha1 and length
+
+Chunk boundaries depend only on the bytes around them, so an insertion
+in a file changes only the chunks around it. Every position gets a hash
+byte of the CDC_WINDOW bytes that end there and a chunk ends after a
+run of CDC_RUN hashes below CDC_BELOW, but not before CDC_MIN nor after
+CDC_MAX bytes. As the hash covers many bytes, cuts are as frequent in
+text as in random data. The hashes of a block are computed at once in
+log2(CDC_WINDOW) rounds of bytes.translate() and an xor of big integers,
+a rolling hash written in Python would be 8 times slower.
+
+    object_format.py verify [--raw] STORE
+"""
+
+import argparse
+import bisect
+import bz2
+import hashlib
+import io
+import lzma
+import os
+import struct
+import sys
+import time
+import zlib
+
+import iosched
+import packs
+
+MAGIC = b"FOBJZ001"
+# magic, algorithm, chunk size, data size, chunks
+TRAILER = struct.Struct("<8sBxxxIQQ")
+CHUNK_SIZE = 256 * 1024
+SUFFIX = ".z"
+# an object is compressed only if its first chunk shrinks below this
+MIN_RATIO = 0.9
+
+# name -> (id, compress, decompress)
+ALGORITHMS = {
+    "zlib": (1, zlib.compress, zlib.decompress),
+    "lzma": (2, lzma.compress, lzma.decompress),
+    "bz2": (3, bz2.compress, bz2.decompress),
+}
+DECOMPRESS = {id_: decompress for id_, _, decompress in ALGORITHMS.values()}
+
+MANIFEST_MAGIC = b"FOBJM001"
+MANIFEST_SUFFIX = ".m"
+# raw sha1, length
+MANIFEST_ENTRY = struct.Struct("<20sQ")
+SUFFIXES = (SUFFIX, MANIFEST_SUFFIX)
+
+CDC_MIN = 256 * 1024
+CDC_MAX = 4 * 1024**2
+# bytes hashed for a position, a power of 2
+CDC_WINDOW = 16
+# a cut has a chance of 1 / 16**5 at each position, about 1 MiB after
+# CDC_MIN
+CDC_RUN = 5
+CDC_BELOW = 16
+CDC_MARK = b"1" * CDC_RUN
+CDC_TABLE = bytes(b"1"[0] if i < CDC_BELOW else b"0"[0] for i in range(256))
+# positions hashed at once
+CDC_BLOCK = 128 * 1024
+# a permutation of the byte values per round, picked by a fixed hash.
+# Changing them changes all the chunks.
+CDC_SBOXES = [
+    bytes(
+        sorted(
+            range(256),
+            key=lambda i: hashlib.blake2b(bytes([r, i]), digest_size=8).digest(),
+        )
+    )
+    for r in range(CDC_WINDOW.bit_length())
+]
+
+
+def compresses(data, algo):
+    compress = ALGORITHMS[algo][1]
+    return len(compress(data)) < len(data) * MIN_RATIO
+
+
+def compress_bytes(data, algo):
+    """Return the compressed object of data."""
+    return b"".join(encode(io.BytesIO(data), algo))
+
+
+def encode(f, algo, h=None, chunk_size=CHUNK_SIZE, head=b""):
+    """
+    Yield the compressed object of the data read from the file f, in
+    pieces. head is the first chunk, if the caller already read it from f.
+    h, a hashlib object, is updated with the data.
+    """
+    id_, compress, _ = ALGORITHMS[algo]
+    offsets = [0]
+    size = 0
+    while True:
+        data = head or f.read(chunk_size)
+        head = b""
+        if not data:
+            break
+        if h is not None:
+            h.update(data)
+        packed = compress(data)
+        if len(packed) >= len(data):
+            packed = data
+        size += len(data)
+        offsets.append(offsets[-1] + len(packed))
+        yield packed
+    yield struct.pack("<{}Q".format(len(offsets)), *offsets)
+    yield TRAILER.pack(MAGIC, id_, chunk_size, size, len(offsets) - 1)
+
+
+def window_hash(data):
+    """
+    Return a byte per position of data, a hash of the CDC_WINDOW bytes
+    that end there. The first CDC_WINDOW - 1 hash fewer bytes.
+    """
+    n = len(data)
+    mask = (1 << 8 * n) - 1
+    s = data.translate(CDC_SBOXES[0])
+    x = int.from_bytes(s, "little")
+    w = 1
+    for sbox in CDC_SBOXES[1:]:
+        # the hash of 2w bytes is the permuted hash of the last w bytes
+        # xor the hash of the w bytes before them
+        x = int.from_bytes(s.translate(sbox), "little") ^ ((x << 8 * w) & mask)
+        s = x.to_bytes(n, "little")
+        w *= 2
+    return s
+
+
+def find_cut(buf, min_size=CDC_MIN, max_size=CDC_MAX):
+    """Return the length of the first chunk of buf."""
+    n = min(len(buf), max_size)
+    if n <= min_size:
+        return n
+    # bytes that decide a cut
+    span = CDC_WINDOW + CDC_RUN - 1
+    start = min_size - span
+    while True:
+        end = min(start + CDC_BLOCK, n)
+        marks = window_hash(buf[start:end]).translate(CDC_TABLE)
+        i = marks.find(CDC_MARK, CDC_WINDOW - 1)
+        if i >= 0:
+            return start + i + CDC_RUN
+        if end == n:
+            return n
+        start = end - span + 1
+
+
+def cdc_chunks(f, min_size=CDC_MIN, max_size=CDC_MAX):
+    """Yield the content defined chunks of the data read from the file f."""
+    buf = b""
+    eof = False
+    while True:
+        while not eof and len(buf) < max_size:
+            data = f.read(max_size)
+            eof = not data
+            buf += data
+        if not buf:
+            return
+        cut = find_cut(buf, min_size, max_size)
+        yield buf[:cut]
+        buf = buf[cut:]
+
+
+def manifest(entries):
+    """Return a manifest of the (raw sha1, length) of the chunks."""
+    return MANIFEST_MAGIC + b"".join(MANIFEST_ENTRY.pack(*e) for e in entries)
+
+
+class RawObject:
+    """Random access to an object stored as it is."""
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+
+    def read(self, off, size):
+        return os.pread(self.fd, size, off)
+
+    def sha1(self, budget=None):
+        h = hashlib.sha1()
+        for off in range(0, self.size, CHUNK_SIZE):
+            if budget:
+                budget.acquire(min(CHUNK_SIZE, self.size - off))
+            h.update(self.read(off, CHUNK_SIZE))
+        return h.hexdigest()
+
+    def close(self):
+        os.close(self.fd)
+
+
+class CompressedObject:
+    """
+    Random access to the data of a compressed object. The last chunk read
+    is kept, so sequential reads smaller than a chunk decompress it once.
+    """
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+        try:
+            end = os.fstat(self.fd).st_size - TRAILER.size
+            magic, algo, self.chunk_size, self.size, chunks = TRAILER.unpack(
+                os.pread(self.fd, TRAILER.size, max(end, 0))
+            )
+            if magic != MAGIC:
+                raise ValueError("{} is not a compressed object".format(path))
+            table_size = (chunks + 1) * 8
+            self.offsets = struct.unpack(
+                "<{}Q".format(chunks + 1),
+                os.pread(self.fd, table_size, end - table_size),
+            )
+            self.decompress = DECOMPRESS[algo]
+        except BaseException:
+            os.close(self.fd)
+            raise
+        self.cached = None
+        self.cached_data = b""
+
+    def chunk(self, i):
+        if self.cached != i:
+            start, end = self.offsets[i], self.offsets[i + 1]
+            data = os.pread(self.fd, end - start, start)
+            if len(data) != min(self.chunk_size, self.size - i * self.chunk_size):
+                data = self.decompress(data)
+            self.cached = i
+            self.cached_data = data
+        return self.cached_data
+
+    def read(self, off, size):
+        end = min(off + size, self.size)
+        if off >= end:
+            return b""
+        parts = []
+        for i in range(off // self.chunk_size, (end - 1) // self.chunk_size + 1):
+            base = i * self.chunk_size
+            parts.append(self.chunk(i)[max(off - base, 0) : end - base])
+        return b"".join(parts)
+
+    def sha1(self, budget=None):
+        h = hashlib.sha1()
+        for i in range(len(self.offsets) - 1):
+            if budget:
+                budget.acquire(self.offsets[i + 1] - self.offsets[i])
+            h.update(self.chunk(i))
+        return h.hexdigest()
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ChunkedObject:
+    """
+    Random access to the data of a manifest. The chunk read last is kept
+    open. Chunks are looked up in packed_objects too, a packs.Packs of the
+    store: a chunk can be the same as a small file that was packed.
+    """
+
+    def __init__(self, root, path, packed_objects=None):
+        self.root = root
+        self.packed_objects = packed_objects
+        self.fd = os.open(path, os.O_RDONLY)
+        try:
+            with open(self.fd, "rb", closefd=False) as f:
+                data = f.read()
+            if not data.startswith(MANIFEST_MAGIC):
+                raise ValueError("{} is not a manifest".format(path))
+            entries = data[len(MANIFEST_MAGIC) :]
+            entries = entries[: len(entries) - len(entries) % MANIFEST_ENTRY.size]
+        except BaseException:
+            os.close(self.fd)
+            raise
+        self.hashes = []
+        self.offsets = [0]
+        for digest, length in MANIFEST_ENTRY.iter_unpack(entries):
+            self.hashes.append(digest.hex())
+            self.offsets.append(self.offsets[-1] + length)
+        self.size = self.offsets[-1]
+        self.current = None
+        self.current_obj = None
+
+    def chunk(self, i):
+        if self.current != i:
+            if self.current_obj is not None:
+                self.current_obj.close()
+                self.current_obj = None
+            self.current_obj = open_object(
+                self.root, self.hashes[i], self.packed_objects, chunks=False
+            )
+            self.current = i
+        return self.current_obj
+
+    def read(self, off, size):
+        end = min(off + size, self.size)
+        parts = []
+        i = bisect.bisect_right(self.offsets, off) - 1
+        while off < end:
+            n = min(end, self.offsets[i + 1]) - off
+            parts.append(self.chunk(i).read(off - self.offsets[i], n))
+            off += n
+            i += 1
+        return b"".join(parts)
+
+    def sha1(self, budget=None):
+        h = hashlib.sha1()
+        for off in range(0, self.size, CDC_MAX):
+            if budget:
+                budget.acquire(min(CDC_MAX, self.size - off))
+            h.update(self.read(off, CDC_MAX))
+        return h.hexdigest()
+
+    def close(self):
+        if self.current_obj is not None:
+            self.current_obj.close()
+        os.close(self.fd)
+
+
+def open_object(root, hash_, packed_objects=None, chunks=True):
+    """
+    Open the object of a hex SHA-1 of a store: raw, compressed, packed if
+    packed_objects, the packs.Packs of the store, is given or, with chunks,
+    a manifest. Return a RawObject, CompressedObject, packs.PackedObject or
+    ChunkedObject.
+    """
+    path = os.path.join(root, hash_[0:2], hash_[2:4], hash_)
+    try:
+        return RawObject(path)
+    except FileNotFoundError:
+        pass
+    if packed_objects is not None:
+        obj = packed_objects.open(hash_)
+        if obj is not None:
+            return obj
+    try:
+        return CompressedObject(path + SUFFIX)
+    except FileNotFoundError:
+        if not chunks:
+            raise
+    return ChunkedObject(root, path + MANIFEST_SUFFIX, packed_objects)
+
+
+def _subdirs(path):
+    with os.scandir(path) as entries:
+        return sorted(
+            (e.name, e.path) for e in entries if len(e.name) == 2 and e.is_dir()
+        )
+
+
+def objects(root, raw=False, start=""):
+    """
+    Yield (hex sha1, path) of the compressed objects and the manifests of
+    a store, with raw the plain objects too, in hash order from start.
+    """
+    suffixes = SUFFIXES + ("",) if raw else SUFFIXES
+    for name1, path1 in _subdirs(root):
+        if name1 < start[:2]:
+            continue
+        for name2, path2 in _subdirs(path1):
+            with os.scandir(path2) as entries:
+                names = sorted(e.name for e in entries if e.is_file())
+            for name in names:
+                if len(name) >= 40 and name[40:] in suffixes and name >= start:
+                    yield name[:40], os.path.join(path2, name)
+
+
+def verify(root, verbose=False, budget=None, raw=False, start=""):
+    """
+    Check the SHA-1 of every compressed object and manifest, with raw of
+    every object, reading at the rate of the iosched.Budget budget. Return
+    the number of objects, of data bytes, of stored bytes and the list of
+    bad paths. The chunks of a manifest are read, their own objects are
+    checked like the others.
+    """
+    budget = budget or iosched.Budget()
+    packed_objects = packs.Packs(root)
+    count = 0
+    size = 0
+    stored = 0
+    bad = []
+    for hash_, path in objects(root, raw, start):
+        if verbose:
+            print("Checking {}".format(path))
+        count += 1
+        try:
+            if path.endswith(MANIFEST_SUFFIX):
+                obj = ChunkedObject(root, path, packed_objects)
+            elif path.endswith(SUFFIX):
+                obj = CompressedObject(path)
+            else:
+                obj = RawObject(path)
+            budget.acquire()
+            try:
+                ok = obj.sha1(budget) == hash_
+                size += obj.size
+            finally:
+                obj.close()
+        except Exception as e:
+            # any damage, from the trailer to the compressed data
+            ok = False
+            print("{}: {}".format(path, e))
+        stored += os.path.getsize(path)
+        if not ok:
+            bad.append(path)
+            print("{}: FAILED".format(path))
+    return count, size, stored, bad
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Tools for the compressed and chunked objects of a store"
+    )
+    parser.add_argument("command", choices=("verify",))
+    parser.add_argument("store", help="Archive directory")
+    parser.add_argument(
+        "--raw", action="store_true", help="Check the plain objects too"
+    )
+    parser.add_argument(
+        "--start-with",
+        default="",
+        metavar="PREFIX",
+        help="Skip the objects whose hash sorts before PREFIX",
+    )
+    parser.add_argument("-v", action="store_true", help="verbose")
+    iosched.add_arguments(parser)
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    count, size, stored, bad = verify(
+        args.store, args.v, iosched.from_args(args), args.raw, args.start_with
+    )
+    print(
+        """Counters:
+    Checked objects:     {:12d}
+    Data MB:             {:12.0f}
+    Stored MB:           {:12.0f}
+    Failed objects:      {:12d}
+    Time (s):            {:12.1f}""".format(
+            count,
+            size / 1024**2,
+            stored / 1024**2,
+            len(bad),
+            time.monotonic() - start,
+        )
+    )
+    sys.exit(1 if bad else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Pack files of an archive store.
+
+copy_files.py stores every object in <store>/xx/yy/<sha1>, one file per
+object. With --pack-below, small objects are appended to pack files
+instead, so that millions of them do not cost millions of inodes:
+
+    <store>/packs/pack-NNNNNN.pack  objects, each one after a HEADER
+    <store>/packs/pack-NNNNNN.idx   ENTRY per object of the pack
+
+An entry is appended to the .idx only after the pack data is fsync'ed, so
+every indexed object is complete. Data left in a pack without an entry
+after a crash is never read, the object is copied again by the next run.
+A pack is written by one process only and never reopened for writing.
+
+    packs.py verify STORE
+"""
+
+import argparse
+import glob
+import hashlib
+import os
+import re
+import struct
+import sys
+import threading
+import time
+
+import iosched
+
+PACK_SIZE = 1024**3
+# objects indexed but not yet written to the .idx
+FLUSH_OBJECTS = 1000
+# before each object in a pack: sha1, length
+HEADER = struct.Struct("<20sQ")
+# in the .idx: sha1, offset of the data in the pack, length
+ENTRY = struct.Struct("<20sQQ")
+
+PACK_RE = re.compile(r"pack-(\d+)\.idx$")
+
+
+def pack_path(root, number, ext="pack"):
+    return os.path.join(root, "packs", "pack-{:06d}.{}".format(number, ext))
+
+
+def pack_numbers(root):
+    numbers = []
+    for path in glob.glob(os.path.join(glob.escape(root), "packs", "pack-*.idx")):
+        m = PACK_RE.search(path)
+        if m:
+            numbers.append(int(m.group(1)))
+    return sorted(numbers)
+
+
+def read_entries(root, number):
+    """Yield (sha1, offset, length) of the objects of a pack, sha1 raw."""
+    with open(pack_path(root, number, "idx"), "rb") as f:
+        data = f.read()
+    # a partial entry at the end is the trace of a crash
+    end = len(data) - len(data) % ENTRY.size
+    yield from ENTRY.iter_unpack(data[:end])
+
+
+class Packs:
+    """The objects of all the packs of a store, by raw SHA-1."""
+
+    def __init__(self, root):
+        self.root = root
+        # sha1 -> (pack number, offset, length)
+        self.objects = {}
+        for number in pack_numbers(root):
+            for digest, offset, length in read_entries(root, number):
+                self.objects[digest] = (number, offset, length)
+
+    def __contains__(self, digest):
+        return digest in self.objects
+
+    def __len__(self):
+        return len(self.objects)
+
+    def locate(self, hash_):
+        """Return (pack path, offset, length) of a hex SHA-1, or None."""
+        found = self.objects.get(bytes.fromhex(hash_))
+        if found is None:
+            return None
+        number, offset, length = found
+        return pack_path(self.root, number), offset, length
+
+    def open(self, hash_):
+        """Return a PackedObject for a hex SHA-1, or None if not packed."""
+        found = self.locate(hash_)
+        return PackedObject(*found) if found else None
+
+
+class PackedObject:
+    """Random access to an object in a pack, like object_format.RawObject."""
+
+    def __init__(self, path, offset, length):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.offset = offset
+        self.size = length
+
+    def read(self, off, size):
+        size = max(0, min(size, self.size - off))
+        return os.pread(self.fd, size, self.offset + off)
+
+    def sha1(self, budget=None):
+        if budget:
+            budget.acquire(self.size)
+        return hashlib.sha1(self.read(0, self.size)).hexdigest()
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PackWriter:
+    """
+    Append objects to new packs of a store. add() may be called from
+    several threads.
+    """
+
+    def __init__(self, root, pack_size=PACK_SIZE):
+        self.root = root
+        self.pack_size = pack_size
+        self.lock = threading.Lock()
+        self.number = max(pack_numbers(root), default=0)
+        self.fd = None
+        self.offset = 0
+        self.pending = []
+        # (sha1, offset, length) of objects added, whose entry could not
+        # be written after all
+        self.lost = []
+
+    def _open(self):
+        os.makedirs(os.path.join(self.root, "packs"), exist_ok=True)
+        while True:
+            self.number += 1
+            try:
+                self.fd = os.open(
+                    pack_path(self.root, self.number),
+                    os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                    0o644,
+                )
+            except FileExistsError:
+                # another process writes this pack
+                continue
+            break
+        self.offset = 0
+        # the .idx marks the pack as taken for pack_numbers()
+        open(pack_path(self.root, self.number, "idx"), "ab").close()
+
+    def _write(self, data):
+        # unbuffered, so that everything before self.offset is written
+        with memoryview(data) as view:
+            while view:
+                view = view[os.write(self.fd, view) :]
+
+    def _flush(self):
+        os.fsync(self.fd)
+        if self.pending:
+            with open(pack_path(self.root, self.number, "idx"), "ab") as f:
+                # drop a partial entry left by a failed write
+                end = os.fstat(f.fileno()).st_size
+                f.truncate(end - end % ENTRY.size)
+                f.write(b"".join(ENTRY.pack(*entry) for entry in self.pending))
+                f.flush()
+                os.fsync(f.fileno())
+            self.pending = []
+
+    def _close_pack(self):
+        """
+        Index the pending objects and close the pack. Objects that cannot
+        be indexed are added to lost.
+        """
+        try:
+            self._flush()
+        except OSError:
+            self.lost.extend(self.pending)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+            self.pending = []
+
+    def add(self, digest, data):
+        """
+        Append an object, digest is its raw SHA-1. An error is raised for
+        this object only: the objects added before are indexed, or added
+        to lost.
+        """
+        with self.lock:
+            if self.fd is None:
+                self._open()
+            entry = (digest, self.offset + HEADER.size, len(data))
+            try:
+                self._write(HEADER.pack(digest, len(data)) + data)
+            except OSError:
+                # keep the pack up to the objects written before, and
+                # start a new one
+                try:
+                    os.ftruncate(self.fd, self.offset)
+                except OSError:
+                    pass
+                self._close_pack()
+                raise
+            self.pending.append(entry)
+            self.offset = entry[1] + entry[2]
+            if self.offset < self.pack_size and len(self.pending) < FLUSH_OBJECTS:
+                return
+            try:
+                self._flush()
+            except OSError:
+                self.pending.pop()
+                self._close_pack()
+                raise
+            if self.offset >= self.pack_size:
+                self._close_pack()
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                self._close_pack()
+
+
+def verify(root, verbose=False, budget=None):
+    """
+    Check the SHA-1 of every packed object, reading at the rate of the
+    iosched.Budget budget. Return the number of objects, of bytes and the
+    list of bad (hex sha1, pack path, offset).
+    """
+    budget = budget or iosched.Budget()
+    objects = 0
+    size = 0
+    bad = []
+    for number in pack_numbers(root):
+        path = pack_path(root, number)
+        if verbose:
+            print("Checking {}".format(path))
+        with open(path, "rb") as f:
+            for digest, offset, length in read_entries(root, number):
+                budget.acquire(length)
+                data = os.pread(f.fileno(), length, offset)
+                objects += 1
+                size += length
+                if hashlib.sha1(data).digest() != digest:
+                    bad.append((digest.hex(), path, offset))
+                    print("{}: FAILED in {} at {}".format(digest.hex(), path, offset))
+    return objects, size, bad
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tools for the packs of a store")
+    parser.add_argument("command", choices=("verify",))
+    parser.add_argument("store", help="Archive directory")
+    parser.add_argument("-v", action="store_true", help="verbose")
+    iosched.add_arguments(parser)
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    objects, size, bad = verify(args.store, args.v, iosched.from_args(args))
+    print(
+        """Counters:
+    Packed objects:      {:12d}
+    Packed MB:           {:12.0f}
+    Failed objects:      {:12d}
+    Time (s):            {:12.1f}""".format(
+            objects, size / 1024**2, len(bad), time.monotonic() - start
+        )
+    )
+    sys.exit(1 if bad else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import csv
 import os
 import sys
 import fnmatch
@@ -10,10 +9,14 @@ import os.path
 from pathlib import Path
 import re
 
+import index_format
+import index_sort
+
 # globals
 args = None
 index = {}
 translate = []
+missing = 0
 
 
 def match_filter(path):
@@ -33,20 +36,27 @@ def load_index(index_filename):
     global index
     global translate
 
-    with open(index_filename) as index_file:
-        reader = csv.reader(index_file)
-        for row in reader:
-            hash, mtime, size, path = row[:]
-            if not match_filter(path):
-                continue
+    for row in index_format.read_index(index_filename):
+        hash, mtime, size, path = row[:]
+        path = select_path(path)
+        if path is None:
+            continue
+
+        if hash not in index:
+            index[hash] = []
+        index[hash].append((path, mtime, size))
+
 
-            # translate path
-            for search, replace in translate:
-                path = re.sub(search,replace, path)
+def select_path(path):
+    """ Return the translated path or None if it does not match the filter """
 
-            if hash not in index:
-                index[hash] = []
-            index[hash].append((path, mtime, size))
+    if not match_filter(path):
+        return None
+
+    # translate path
+    for search, replace in translate:
+        path = re.sub(search,replace, path)
+    return path
 
 def load_translate():
     global args
@@ -60,15 +70,28 @@ def load_translate():
         translate.append((expr, replace))
 
 
-def make_link(h):
+def make_link(h, sources):
+    """
+    Symlink the paths of a hash to its object. Only a raw object is a file
+    that a link can point to: a hash stored in a pack, compressed (.z) or
+    chunked (.m) is skipped, as is a hash missing from the source.
+    """
+
+    global missing
 
-    for path_, mtime, size in index[h]:
+    src = Path(args.source) / h[0:2] / h[2:4] / h
+    if not os.path.isfile(src):
+        missing += 1
+        if args.v > 0:
+            print("W: no raw object {}, skipping".format(src), file=sys.stderr)
+        return
+
+    for path_, mtime, size in sources:
         if path_[0] == '/':
             path_ = path_[1:]
         dst = Path(args.root) / path_
         if os.path.lexists(dst):
             return
-        src = Path(args.source) / h[0:2] / h[2:4] / h
         dst_dir = dst.parent
         if not os.path.isdir(dst_dir):
             if args.v > 0:
@@ -86,7 +109,10 @@ def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--source', '-s', required=True,
-            help='Source of the archive. This is where all symlink will point to.')
+            help='Source of the archive. This is where all symlink will point to.'
+            ' Only raw objects can be linked: a store written with'
+            ' --pack-below, --compress or --chunk-above holds objects that'
+            ' are not plain files, use mount.py to read it.')
     parser.add_argument('--root', '-r', required=True,
             help='This is the root of the created tree. It will not delete'
             ' or overwrite existing content.')
@@ -97,6 +123,10 @@ def main():
             help='index files')
     parser.add_argument('-v', action='count', default=0,
             help='verbose')
+    parser.add_argument('--sorted', action='store_true',
+            help='The indexes are sorted by hash, e.g. catalogs written by'
+            ' merge_index.py. They are read one hash at a time instead of'
+            ' being loaded.')
     parser.add_argument('--translate', '-t', nargs=2, action='append',
             help='Translate prefixes. format is <pattern> <replace>, where'
             ' pattern and replace are regex and replace string as defined in re.sub')
@@ -104,11 +134,23 @@ def main():
     args = parser.parse_args()
     load_translate()
 
-    for idx_file in args.index:
-        load_index(idx_file)
-
-    for h in index:
-        make_link(h)
+    if args.sorted:
+        for h, sources in index_sort.hash_groups(args.index):
+            sources = [(select_path(path), mtime, size)
+                    for path, mtime, size in sources]
+            sources = [s for s in sources if s[0] is not None]
+            if sources:
+                make_link(h, sources)
+    else:
+        for idx_file in args.index:
+            load_index(idx_file)
+
+        for h in index:
+            make_link(h, index[h])
+
+    if missing:
+        print("W: {} hashes have no raw object in {} and were skipped".format(
+            missing, args.source), file=sys.stderr)
 
 
 if __name__ == '__main__':